@@ -1,12 +1,35 @@
 import streamlit as st
 import pandas as pd
 import psycopg2
+import psycopg2.errors
 from datetime import datetime, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from fpdf import FPDF
+import cProfile
+import functools
+import gzip
+import io
 import json
+import os
+import select
+import tempfile
+import threading
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pstats
+import re
+import secrets
+import shutil
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from migrar_bd import TRIGGERS, VERSIONES_CACHE
+from motor_ventas import PoolVentas, StockInsuficiente, registrar_venta_concurrente
 
 # Configuración de la página
 st.set_page_config(
@@ -17,16 +40,19 @@ st.set_page_config(
 )
 
 # Conexión a PostgreSQL
+def parametros_conexion():
+    return {
+        "host": st.secrets["DB_HOST"],
+        "database": st.secrets["DB_NAME"],
+        "user": st.secrets["DB_USER"],
+        "password": st.secrets["DB_PASSWORD"],
+        "port": st.secrets["DB_PORT"]
+    }
+
 @st.cache_resource
 def init_connection():
     try:
-        conn = psycopg2.connect(
-            host=st.secrets["DB_HOST"],
-            database=st.secrets["DB_NAME"],
-            user=st.secrets["DB_USER"],
-            password=st.secrets["DB_PASSWORD"],
-            port=st.secrets["DB_PORT"]
-        )
+        conn = psycopg2.connect(**parametros_conexion())
         return conn
     except Exception as e:
         st.error(f"Error de conexión: {e}")
@@ -34,17 +60,201 @@ def init_connection():
 
 conn = init_connection()
 
+# Configuración opcional leída de st.secrets
+def configuracion(clave, defecto=None):
+    try:
+        return st.secrets.get(clave, defecto)
+    except Exception:
+        return defecto
+
+# Medición por rerun: cada página acumula el tiempo exclusivo de sus tramos
+# (db, transform, chart, render). Lo que no cae en ningún tramo es render de Streamlit.
+TIPOS_TRAMO = ("db", "transform", "chart", "render")
+PRESUPUESTO_RERUN_MS = float(configuracion("PRESUPUESTO_RERUN_MS", 500))
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_medicion = threading.local()
+
+@contextmanager
+def tramo(tipo):
+    pila = getattr(_medicion, "pila", None)
+    if pila is None:
+        yield
+        return
+    pila.append(0.0)
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        hijos = pila.pop()
+        _medicion.tramos[tipo] = _medicion.tramos.get(tipo, 0.0) + duracion - hijos
+        pila[-1] += duracion
+        if tipo == "db":
+            _medicion.consultas += 1
+
+# Contadores e histogramas del proceso en formato de texto de Prometheus
+METRICAS = {
+    "ferreteria_reruns_total": ("counter", "Reruns ejecutados por página"),
+    "ferreteria_errores_total": ("counter", "Reruns terminados con excepción por página"),
+    "ferreteria_consultas_total": ("counter", "Consultas a la base por página"),
+    "ferreteria_pagina_segundos": ("histogram", "Duración total del rerun por página"),
+    "ferreteria_tramo_segundos": ("histogram", "Tiempo exclusivo por tipo de tramo y página"),
+}
+
+class RegistroMetricas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contadores = {}
+        self.histogramas = {}
+
+    def incrementar(self, nombre, etiquetas, valor=1):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self.lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, etiquetas, valor):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self.lock:
+            buckets, suma, cuenta = self.histogramas.get(clave, ([0] * len(BUCKETS_SEGUNDOS), 0.0, 0))
+            for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                if valor <= limite:
+                    buckets[i] += 1
+            self.histogramas[clave] = (buckets, suma + valor, cuenta + 1)
+
+    def texto_prometheus(self):
+        def etiquetas_texto(etiquetas):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas) + "}"
+
+        proceso = (("proceso", str(os.getpid())),)
+        lineas = []
+        with self.lock:
+            for nombre, (tipo, ayuda) in METRICAS.items():
+                lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+                for (metrica, etiquetas), valor in sorted(self.contadores.items()):
+                    if metrica == nombre:
+                        lineas.append(f"{nombre}{etiquetas_texto(etiquetas + proceso)} {valor}")
+                for (metrica, etiquetas), (buckets, suma, cuenta) in sorted(self.histogramas.items()):
+                    if metrica != nombre:
+                        continue
+                    for limite, acumulado in zip(BUCKETS_SEGUNDOS, buckets):
+                        lineas.append(f"{nombre}_bucket{etiquetas_texto(etiquetas + proceso + (('le', limite),))} {acumulado}")
+                    lineas.append(f"{nombre}_bucket{etiquetas_texto(etiquetas + proceso + (('le', '+Inf'),))} {cuenta}")
+                    lineas.append(f"{nombre}_sum{etiquetas_texto(etiquetas + proceso)} {suma:.6f}")
+                    lineas.append(f"{nombre}_count{etiquetas_texto(etiquetas + proceso)} {cuenta}")
+        return "\n".join(lineas) + "\n"
+
+@st.cache_resource
+def obtener_registro_metricas():
+    registro = RegistroMetricas()
+
+    # Endpoint opcional /metrics; con varios workers solo el primero obtiene el puerto
+    # y el resto exporta por archivo (METRICAS_DIR)
+    puerto = configuracion("METRICAS_PUERTO")
+    if puerto:
+        class ManejadorMetricas(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cuerpo = registro.texto_prometheus().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.end_headers()
+                if self.path == "/metrics":
+                    self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            servidor = ThreadingHTTPServer(("127.0.0.1", int(puerto)), ManejadorMetricas)
+            threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        except OSError:
+            pass
+    return registro
+
+# Un archivo .prom por proceso, para el textfile collector de node_exporter
+def exportar_metricas_archivo(registro):
+    directorio = configuracion("METRICAS_DIR")
+    if not directorio:
+        return
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, f"ferreteria_{os.getpid()}.prom")
+        with open(ruta + ".tmp", "w", encoding="utf-8") as archivo:
+            archivo.write(registro.texto_prometheus())
+        os.replace(ruta + ".tmp", ruta)
+    except OSError:
+        pass
+
+def mostrar_presupuesto(total, tramos, consultas):
+    total_ms = total * 1000
+    icono = "✅" if total_ms <= PRESUPUESTO_RERUN_MS else "⚠️"
+    with st.sidebar.expander(f"⏱️ {icono} Rerun: {total_ms:,.0f} ms / {PRESUPUESTO_RERUN_MS:,.0f} ms"):
+        st.progress(min(total_ms / PRESUPUESTO_RERUN_MS, 1.0))
+        for tipo in TIPOS_TRAMO:
+            st.caption(f"{tipo}: {tramos.get(tipo, 0.0) * 1000:,.1f} ms")
+        st.caption(f"Consultas: {consultas}")
+
+# Decorador de página: mide el rerun, publica las métricas y, para administradores,
+# muestra el presupuesto y el perfil de cProfile si está activado
+def medir_pagina(nombre):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            es_admin = st.session_state.get("user", {}).get("rol") == "admin"
+            perfil = cProfile.Profile() if es_admin and st.session_state.get("perfilar_pagina") else None
+            _medicion.pila = [0.0]
+            _medicion.tramos = {}
+            _medicion.consultas = 0
+            completo = False
+            inicio = time.perf_counter()
+            if perfil:
+                perfil.enable()
+            try:
+                resultado = funcion(*args, **kwargs)
+                completo = True
+                return resultado
+            except Exception:
+                obtener_registro_metricas().incrementar("ferreteria_errores_total", {"pagina": nombre})
+                raise
+            finally:
+                if perfil:
+                    perfil.disable()
+                total = time.perf_counter() - inicio
+                tramos, consultas = _medicion.tramos, _medicion.consultas
+                tramos["render"] = tramos.get("render", 0.0) + total - _medicion.pila[0]
+                _medicion.pila = None
+
+                registro = obtener_registro_metricas()
+                registro.incrementar("ferreteria_reruns_total", {"pagina": nombre})
+                registro.incrementar("ferreteria_consultas_total", {"pagina": nombre}, consultas)
+                registro.observar("ferreteria_pagina_segundos", {"pagina": nombre}, total)
+                for tipo, segundos in tramos.items():
+                    registro.observar("ferreteria_tramo_segundos", {"pagina": nombre, "tipo": tipo}, segundos)
+                exportar_metricas_archivo(registro)
+
+                # Solo si la página terminó: st.rerun() también sale por aquí
+                if completo and es_admin:
+                    mostrar_presupuesto(total, tramos, consultas)
+                    if perfil:
+                        salida = io.StringIO()
+                        pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(30)
+                        with st.expander("🧪 Perfil cProfile"):
+                            st.code(salida.getvalue())
+        return envoltura
+    return decorador
+
 # Función para ejecutar consultas
 def ejecutar_consulta(query, params=None):
     try:
-        cur = conn.cursor()
-        if params:
-            cur.execute(query, params)
-        else:
-            cur.execute(query)
-        result = cur.fetchall()
-        conn.commit()
-        cur.close()
+        with tramo("db"):
+            cur = conn.cursor()
+            if params:
+                cur.execute(query, params)
+            else:
+                cur.execute(query)
+            result = cur.fetchall()
+            conn.commit()
+            cur.close()
         return result
     except Exception as e:
         st.error(f"Error en consulta: {e}")
@@ -53,19 +263,390 @@ def ejecutar_consulta(query, params=None):
 # Función para ejecutar procedimientos almacenados
 def ejecutar_sp(sp_name, params=None):
     try:
-        cur = conn.cursor()
-        if params:
-            cur.callproc(sp_name, params)
-        else:
-            cur.callproc(sp_name)
-        result = cur.fetchall()
-        conn.commit()
-        cur.close()
+        with tramo("db"):
+            cur = conn.cursor()
+            if params:
+                cur.callproc(sp_name, params)
+            else:
+                cur.callproc(sp_name)
+            result = cur.fetchall()
+            conn.commit()
+            cur.close()
         return result
     except Exception as e:
         st.error(f"Error ejecutando SP: {e}")
         return None
 
+# Pool de conexiones dedicadas para el cobro: cada venta necesita su propia transacción
+@st.cache_resource
+def obtener_pool_ventas():
+    try:
+        return PoolVentas(int(configuracion("DB_POOL_VENTAS", 8)), **parametros_conexion())
+    except Exception as e:
+        st.error(f"Error de conexión: {e}")
+        return None
+
+# Exportación con COPY: las filas pasan de PostgreSQL a un CSV comprimido en disco
+# sin construir tuplas ni DataFrames en Python. Usa una conexión propia para no
+# bloquear la conexión compartida mientras dura una exportación larga.
+def exportar_copy_csv_gz(query, params=None, directorio=None):
+    conexion = None
+    archivo = tempfile.NamedTemporaryFile(prefix="export_", suffix=".csv.gz", dir=directorio, delete=False)
+    try:
+        conexion = psycopg2.connect(**parametros_conexion())
+        conexion.set_session(readonly=True)
+        cur = conexion.cursor()
+        consulta = cur.mogrify(query, params).decode(psycopg2.extensions.encodings[conexion.encoding])
+        with gzip.GzipFile(fileobj=archivo, mode="wb", compresslevel=1) as salida:
+            cur.copy_expert(f"COPY ({consulta}) TO STDOUT WITH (FORMAT csv, HEADER)", salida)
+        archivo.close()
+        return archivo.name
+    except Exception as e:
+        archivo.close()
+        os.unlink(archivo.name)
+        st.error(f"Error en exportación: {e}")
+        return None
+    finally:
+        if conexion is not None:
+            conexion.rollback()
+            conexion.close()
+
+# Descargas grandes fuera de Streamlit: st.download_button guarda el archivo entero
+# en la memoria del worker (MediaFileManager) mientras dura la sesión. Con
+# DESCARGAS_PUERTO y DESCARGAS_URL (la dirección pública, p. ej. detrás del proxy)
+# un servidor aparte envía el archivo desde disco por partes y lo borra al terminar.
+# Con varios workers solo el primero obtiene el puerto y sirve el directorio de todos.
+DESCARGAS_DIR = Path(tempfile.gettempdir()) / "ferreteria_descargas"
+DESCARGAS_TTL_SEGUNDOS = 3600
+RUTA_DESCARGA = re.compile(r"^/([A-Za-z0-9_-]{32})/([A-Za-z0-9_.-]+)$")
+
+# Sin servidor de descargas el archivo pasa por la memoria del worker: se limita el rango
+EXPORTACION_MAX_DIAS = int(configuracion("EXPORTACION_MAX_DIAS", 92))
+
+@st.cache_resource
+def obtener_servidor_descargas():
+    puerto, url = configuracion("DESCARGAS_PUERTO"), configuracion("DESCARGAS_URL")
+    if not puerto or not url:
+        return None
+
+    class ManejadorDescargas(BaseHTTPRequestHandler):
+        def do_GET(self):
+            coincide = RUTA_DESCARGA.match(self.path)
+            ruta = DESCARGAS_DIR / coincide.group(1) / coincide.group(2) if coincide else None
+            if ruta is None or not ruta.is_file():
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/gzip")
+            self.send_header("Content-Length", str(ruta.stat().st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{ruta.name}"')
+            self.end_headers()
+            with open(ruta, "rb") as archivo:
+                shutil.copyfileobj(archivo, self.wfile, 1024 * 1024)
+            shutil.rmtree(ruta.parent, ignore_errors=True)
+
+        def log_message(self, *args):
+            pass
+
+    DESCARGAS_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        servidor = ThreadingHTTPServer((configuracion("DESCARGAS_HOST", "127.0.0.1"), int(puerto)), ManejadorDescargas)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    except OSError:
+        pass
+    return url.rstrip("/")
+
+# Exporta a una carpeta con nombre aleatorio (el enlace no se puede adivinar) y
+# devuelve la URL; las descargas que nadie pidió se borran después de una hora
+def publicar_exportacion(url_base, nombre, query, params=None):
+    for carpeta in DESCARGAS_DIR.glob("*"):
+        try:
+            if time.time() - carpeta.stat().st_mtime > DESCARGAS_TTL_SEGUNDOS:
+                shutil.rmtree(carpeta, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+    token = secrets.token_urlsafe(24)
+    carpeta = DESCARGAS_DIR / token
+    carpeta.mkdir(parents=True)
+    ruta = exportar_copy_csv_gz(query, params, directorio=carpeta)
+    if ruta is None:
+        shutil.rmtree(carpeta, ignore_errors=True)
+        return None
+    os.replace(ruta, carpeta / nombre)
+    return f"{url_base}/{token}/{nombre}"
+
+# Para st.download_button con datos diferidos: se ejecuta solo al pulsar el botón
+def exportacion_en_memoria(query, params=None):
+    ruta = exportar_copy_csv_gz(query, params)
+    if ruta is None:
+        raise RuntimeError("No se pudo generar la exportación")
+    try:
+        return Path(ruta).read_bytes()
+    finally:
+        os.unlink(ruta)
+
+CONSULTA_DETALLE_VENTAS = """
+    SELECT v.id as venta_id, v.numero_factura, v.fecha_venta, v.cliente_id, v.metodo_pago,
+           v.total as total_venta, vd.producto_id, vd.cantidad, vd.precio,
+           vd.cantidad * vd.precio as subtotal
+    FROM ventas v
+    JOIN venta_detalles vd ON vd.venta_id = v.id
+    WHERE v.fecha_venta >= %s AND v.fecha_venta < %s::date + 1
+"""
+
+# Objetos auxiliares de base de datos (índices, resúmenes y triggers): los crea
+# migrar_bd.py, no el arranque de la app. Aquí solo se comprueba qué triggers
+# existen; mientras falte uno, las páginas consultan las tablas base en su lugar.
+@st.cache_resource
+def estado_triggers():
+    return {"leidos": float("-inf"), "instalados": set(), "lock": threading.Lock()}
+
+# Se releen cada minuto, así una migración aplicada con la app en marcha se
+# aprovecha sin reiniciar los workers
+def triggers_instalados():
+    estado = estado_triggers()
+    with estado["lock"]:
+        if time.monotonic() - estado["leidos"] < 60:
+            return estado["instalados"]
+        try:
+            with tramo("db"):
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT tgrelid::regclass::text, tgname
+                    FROM pg_trigger
+                    WHERE NOT tgisinternal AND tgenabled <> 'D'
+                      AND tgname = ANY(%s)
+                """, (sorted({nombre for _, nombre in TRIGGERS}),))
+                estado["instalados"] = set(cur.fetchall())
+                conn.commit()
+                cur.close()
+        except Exception:
+            conn.rollback()
+            estado["instalados"] = set()
+        estado["leidos"] = time.monotonic()
+        return estado["instalados"]
+
+def trigger_instalado(tabla, nombre):
+    return (tabla, nombre) in triggers_instalados()
+
+# Monitor de stock bajo: un hilo escucha las notificaciones de la base de datos
+# y mantiene en memoria los productos bajo el mínimo, sin consultas por página
+CANAL_STOCK_BAJO = "stock_bajo"
+
+class MonitorStockBajo:
+    def __init__(self, parametros):
+        self.parametros = parametros
+        self.productos = {}
+        self.conectado = False
+        self.lock = threading.Lock()
+        self.hilo = threading.Thread(target=self._escuchar, name="monitor-stock-bajo", daemon=True)
+        self.hilo.start()
+
+    def _conectar(self):
+        conexion = psycopg2.connect(**self.parametros)
+        conexion.autocommit = True
+        cur = conexion.cursor()
+        cur.execute(f"LISTEN {CANAL_STOCK_BAJO}")
+
+        # Carga completa después del LISTEN para no perder cambios intermedios
+        cur.callproc("sp_productos_stock_bajo")
+        productos = {fila[0]: tuple(fila) for fila in cur.fetchall()}
+        cur.close()
+        with self.lock:
+            self.productos = productos
+        return conexion
+
+    def _aplicar(self, payload):
+        datos = json.loads(payload)
+        with self.lock:
+            if datos["bajo"]:
+                self.productos[datos["id"]] = (
+                    datos["id"], datos["nombre"], datos["stock_actual"], datos["stock_minimo"]
+                )
+            else:
+                self.productos.pop(datos["id"], None)
+
+    def _escuchar(self):
+        while True:
+            conexion = None
+            try:
+                conexion = self._conectar()
+                self.conectado = True
+                while True:
+                    if select.select([conexion], [], [], 5) == ([], [], []):
+                        continue
+                    conexion.poll()
+                    while conexion.notifies:
+                        self._aplicar(conexion.notifies.pop(0).payload)
+            except Exception:
+                # Conexión perdida: se reintenta y se recarga el conjunto completo
+                self.conectado = False
+                time.sleep(5)
+            finally:
+                if conexion is not None:
+                    conexion.close()
+
+    def productos_bajo_minimo(self):
+        with self.lock:
+            return sorted(self.productos.values(), key=lambda p: (p[2], p[1]))
+
+    def esta_bajo(self, producto_id):
+        with self.lock:
+            return self.productos.get(producto_id)
+
+@st.cache_resource
+def obtener_monitor_stock_bajo():
+    if conn is None:
+        return None
+    return MonitorStockBajo(parametros_conexion())
+
+# Sin el trigger de notificación el monitor no recibiría cambios
+def monitor_stock_bajo_activo():
+    monitor = obtener_monitor_stock_bajo()
+    if monitor is not None and monitor.conectado and trigger_instalado("productos", "trg_notificar_stock_bajo"):
+        return monitor
+    return None
+
+def productos_stock_bajo():
+    monitor = monitor_stock_bajo_activo()
+    if monitor is not None:
+        return monitor.productos_bajo_minimo()
+    # El monitor aún no está listo: consulta directa
+    return ejecutar_sp("sp_productos_stock_bajo")
+
+# Caché compartida entre procesos: varios workers de Streamlit cargan los datos
+# frecuentes una sola vez. Cada entrada se guarda con la versión de las tablas de
+# las que depende, así un cambio en la base genera una clave nueva.
+CACHE_TTL_SEGUNDOS = float(configuracion("CACHE_COMPARTIDO_TTL", 300))
+
+# Respaldo por proceso (comportamiento de un solo worker)
+class CacheMemoria:
+    def __init__(self):
+        self.datos = {}
+        self.lock = threading.Lock()
+
+    def leer(self, nombre, firma):
+        with self.lock:
+            entrada = self.datos.get(nombre)
+        if entrada and entrada[0] == firma and time.time() - entrada[1] < CACHE_TTL_SEGUNDOS:
+            return entrada[2]
+        return None
+
+    def guardar(self, nombre, firma, filas):
+        with self.lock:
+            self.datos[nombre] = (firma, time.time(), filas)
+
+# Archivos Arrow IPC en memoria compartida (/dev/shm): los otros procesos los leen
+# con memory map. Las columnas se construyen directamente desde los valores de
+# Python (sin pasar por pandas), así NULL, enteros, Decimal y fechas vuelven iguales.
+class CacheArrowCompartido:
+    def __init__(self, directorio):
+        self.directorio = Path(directorio)
+        self.directorio.mkdir(parents=True, exist_ok=True)
+
+    def _ruta(self, nombre, firma):
+        return self.directorio / f"{nombre}-{firma}.arrow"
+
+    def leer(self, nombre, firma):
+        ruta = self._ruta(nombre, firma)
+        try:
+            if time.time() - ruta.stat().st_mtime >= CACHE_TTL_SEGUNDOS:
+                return None
+            tabla = pa.ipc.open_file(pa.memory_map(str(ruta))).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+        return list(zip(*(columna.to_pylist() for columna in tabla.columns)))
+
+    def guardar(self, nombre, firma, filas):
+        ruta = self._ruta(nombre, firma)
+        temporal = ruta.with_suffix(f".{os.getpid()}.tmp")
+        tabla = pa.table({f"c{i}": pa.array(columna) for i, columna in enumerate(zip(*filas))})
+        with pa.OSFile(str(temporal), "wb") as salida:
+            with pa.ipc.new_file(salida, tabla.schema) as escritor:
+                escritor.write_table(tabla)
+        os.replace(temporal, ruta)
+
+        # Versiones anteriores: los procesos que ya las mapearon conservan su copia
+        for anterior in self.directorio.glob(f"{nombre}-*.arrow"):
+            if anterior != ruta:
+                anterior.unlink(missing_ok=True)
+
+@st.cache_resource
+def obtener_cache_compartido():
+    if configuracion("CACHE_BACKEND", "memoria") == "compartido":
+        directorio = configuracion(
+            "CACHE_COMPARTIDO_DIR",
+            "/dev/shm/ferreteria_cache" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "ferreteria_cache")
+        )
+        try:
+            return CacheArrowCompartido(directorio)
+        except OSError as e:
+            st.warning(f"Caché compartida no disponible ({e}); se usa caché local")
+    return CacheMemoria()
+
+@st.cache_resource
+def estado_versiones():
+    return {"leidas": 0.0, "valores": {}, "lock": threading.Lock()}
+
+# Las versiones se releen como máximo una vez por segundo por proceso. Cada clave
+# (ver VERSIONES_CACHE en migrar_bd.py) se reparte en varias filas; su versión es
+# un hash de todas ellas, que cambia con cualquier transacción confirmada.
+# Una clave sin su trigger no tiene versión (no cambiaría nunca): esos datos se
+# consultan siempre en la base.
+def versiones_tablas():
+    estado = estado_versiones()
+    with estado["lock"]:
+        if time.monotonic() - estado["leidas"] < 1:
+            return estado["valores"]
+        try:
+            with tramo("db"):
+                cur = conn.cursor()
+                # "fecha" funciona como una versión más para los datos que dependen de CURRENT_DATE
+                valores = ", ".join(["(%s, %s, %s)"] * len(VERSIONES_CACHE))
+                cur.execute(f"""
+                    SELECT c.clave,
+                           left(md5(COALESCE(string_agg(v.particion || ':' || v.version, ',' ORDER BY v.particion), '')), 12)
+                    FROM (VALUES {valores}) AS c(clave, tabla, disparador)
+                    JOIN pg_trigger t ON t.tgrelid = to_regclass(c.tabla) AND t.tgname = c.disparador
+                                     AND t.tgenabled <> 'D'
+                    LEFT JOIN cache_versiones v ON v.clave = c.clave
+                    GROUP BY c.clave
+                    UNION ALL
+                    SELECT 'fecha', to_char(CURRENT_DATE, 'YYYYMMDD')
+                """, [v for clave, tabla, trigger, _ in VERSIONES_CACHE for v in (clave, tabla, trigger)])
+                estado["valores"] = dict(cur.fetchall())
+                conn.commit()
+                cur.close()
+        except Exception:
+            conn.rollback()
+            estado["valores"] = {}
+        estado["leidas"] = time.monotonic()
+        return estado["valores"]
+
+# Tras una escritura propia se releen las versiones en la siguiente consulta
+def refrescar_versiones():
+    estado_versiones()["leidas"] = 0.0
+
+def datos_compartidos(nombre, claves, cargar):
+    versiones = versiones_tablas()
+    if not all(clave in versiones for clave in claves):
+        return cargar()
+
+    firma = "-".join(f"{clave}{versiones[clave]}" for clave in claves)
+    cache = obtener_cache_compartido()
+    filas = cache.leer(nombre, firma)
+    if filas is not None:
+        return filas
+
+    filas = cargar()
+    if filas is not None:
+        try:
+            cache.guardar(nombre, firma, filas)
+        except Exception:
+            pass
+    return filas
+
 # Autenticación
 def login():
     st.sidebar.title("🔐 Sistema de Ferretería")
@@ -95,6 +676,7 @@ def login():
             st.sidebar.error("❌ Usuario o contraseña incorrectos o inactivo")
 
 # Dashboard principal
+@medir_pagina("dashboard")
 def dashboard():
     st.title("🏪 Dashboard - Sistema de Gestión de Ferretería")
 
@@ -102,20 +684,23 @@ def dashboard():
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        ventas_hoy = ejecutar_consulta("SELECT COALESCE(SUM(total), 0) FROM ventas WHERE fecha_venta::date = CURRENT_DATE")
-        st.metric("💰 Ventas Hoy", f"${ventas_hoy[0][0]:,.2f}" if ventas_hoy else "$0")
+        resumen = datos_compartidos("dashboard_resumen", ("ventas", "productos", "clientes", "fecha"), lambda: ejecutar_consulta("""
+            SELECT (SELECT COALESCE(SUM(total), 0) FROM ventas
+                    WHERE fecha_venta >= CURRENT_DATE AND fecha_venta < CURRENT_DATE + 1),
+                   (SELECT COUNT(*) FROM productos WHERE activo = true),
+                   (SELECT COUNT(*) FROM clientes)
+        """))
+        st.metric("💰 Ventas Hoy", f"${resumen[0][0]:,.2f}" if resumen else "$0")
 
     with col2:
-        productos_total = ejecutar_consulta("SELECT COUNT(*) FROM productos WHERE activo = true")
-        st.metric("📦 Productos", productos_total[0][0] if productos_total else 0)
+        st.metric("📦 Productos", resumen[0][1] if resumen else 0)
 
     with col3:
-        stock_bajo = ejecutar_sp("sp_productos_stock_bajo")
+        stock_bajo = productos_stock_bajo()
         st.metric("⚠️ Stock Bajo", len(stock_bajo) if stock_bajo else 0)
 
     with col4:
-        clientes_total = ejecutar_consulta("SELECT COUNT(*) FROM clientes")
-        st.metric("👥 Clientes", clientes_total[0][0] if clientes_total else 0)
+        st.metric("👥 Clientes", resumen[0][2] if resumen else 0)
 
     st.markdown("---")
 
@@ -124,39 +709,41 @@ def dashboard():
 
     with col1:
         st.subheader("📊 Productos por Categoría")
-        cat_data = ejecutar_consulta("""
+        cat_data = datos_compartidos("dashboard_categorias", ("categorias", "productos"), lambda: ejecutar_consulta("""
             SELECT c.nombre, COUNT(p.id)
             FROM categorias c
             LEFT JOIN productos p ON c.id = p.categoria_id
             GROUP BY c.nombre
-        """)
+        """))
         if cat_data:
             df_cat = pd.DataFrame(cat_data, columns=['Categoría', 'Cantidad'])
-            fig = px.pie(df_cat, values='Cantidad', names='Categoría')
+            with tramo("chart"):
+                fig = px.pie(df_cat, values='Cantidad', names='Categoría')
             st.plotly_chart(fig, use_container_width=True)
 
     with col2:
         st.subheader("📈 Ventas Últimos 7 Días")
-        ventas_data = ejecutar_consulta("""
+        ventas_data = datos_compartidos("dashboard_ventas_7_dias", ("ventas", "fecha"), lambda: ejecutar_consulta("""
             SELECT fecha_venta::date as fecha, SUM(total) as total
             FROM ventas
             WHERE fecha_venta >= CURRENT_DATE - INTERVAL '7 days'
             GROUP BY fecha_venta::date
             ORDER BY fecha
-        """)
+        """))
         if ventas_data:
             df_ventas = pd.DataFrame(ventas_data, columns=['Fecha', 'Total'])
-            fig = px.line(df_ventas, x='Fecha', y='Total', title='Ventas Diarias')
+            with tramo("chart"):
+                fig = px.line(df_ventas, x='Fecha', y='Total', title='Ventas Diarias')
             st.plotly_chart(fig, use_container_width=True)
 
     # Productos con stock bajo
     st.subheader("⚠️ Productos con Stock Bajo")
-    stock_bajo_data = ejecutar_sp("sp_productos_stock_bajo")
-    if stock_bajo_data:
-        df_stock = pd.DataFrame(stock_bajo_data, columns=['ID', 'Producto', 'Stock Actual', 'Stock Mínimo'])
+    if stock_bajo:
+        df_stock = pd.DataFrame(stock_bajo, columns=['ID', 'Producto', 'Stock Actual', 'Stock Mínimo'])
         st.dataframe(df_stock, use_container_width=True)
 
 # Módulo generar ticket venta
+@tramo("render")
 def generar_ticket(venta_id):
     # Obtener cabecera
     venta = ejecutar_consulta("""
@@ -232,7 +819,89 @@ def generar_ticket(venta_id):
 
     return pdf.output(dest="S").encode("latin-1")
 
+# Reposición: punto de reorden y cantidad sugerida para todos los productos a la vez.
+# La base suma la demanda de cada día con venta y devuelve por producto la suma y
+# la suma de cuadrados (una fila por producto, no por producto y día); media y
+# varianza salen de esas sumas, contando como cero los días sin venta.
+NIVELES_SERVICIO = {"90%": 1.2816, "95%": 1.6449, "97.5%": 1.96, "99%": 2.3263}
+DIAS_HISTORIA_REPOSICION = [90, 180, 365, 730]
+
+# Los últimos "dias" días completos según la fecha de la base (sin el día en curso)
+def demanda_por_producto(dias):
+    return ejecutar_consulta("""
+        SELECT producto_id, SUM(unidades), SUM(unidades * unidades)
+        FROM (
+            SELECT d.producto_id, SUM(d.cantidad)::float8 AS unidades
+            FROM venta_detalles d
+            JOIN ventas v ON v.id = d.venta_id
+            WHERE v.fecha_venta >= CURRENT_DATE - %s AND v.fecha_venta < CURRENT_DATE
+            GROUP BY d.producto_id, v.fecha_venta::date
+        ) diaria
+        GROUP BY producto_id
+    """, (dias,))
+
+@tramo("transform")
+def calcular_reposicion(productos, demanda, dias, plazo_entrega, z, dias_cobertura):
+    df = pd.DataFrame(productos, columns=["id", "nombre", "stock_actual", "stock_minimo", "precio_compra"])
+    df["precio_compra"] = df["precio_compra"].astype(float)
+    ids = df["id"].to_numpy()
+    stock = df["stock_actual"].fillna(0).to_numpy(dtype=float)
+
+    suma = np.zeros(len(df))
+    suma_cuadrados = np.zeros(len(df))
+    if demanda and len(df):
+        venta_ids, sumas, cuadrados = np.array(demanda, dtype=float).T
+        venta_ids = venta_ids.astype(np.int64)
+        pos = np.searchsorted(ids, venta_ids)
+        # Descarta productos inactivos o ya eliminados
+        valido = (pos < len(ids)) & (ids[np.minimum(pos, len(ids) - 1)] == venta_ids)
+        suma[pos[valido]] = sumas[valido]
+        suma_cuadrados[pos[valido]] = cuadrados[valido]
+
+    media = suma / dias
+    desviacion = np.sqrt(np.maximum(suma_cuadrados - suma ** 2 / dias, 0) / max(dias - 1, 1))
+    stock_seguridad = np.ceil(z * desviacion * np.sqrt(plazo_entrega))
+    punto_reorden = np.ceil(media * plazo_entrega) + stock_seguridad
+
+    # Al llegar al punto de reorden se pide hasta cubrir el plazo más los días de cobertura
+    cantidad = np.where(
+        (suma > 0) & (stock <= punto_reorden),
+        np.ceil(punto_reorden + media * dias_cobertura - stock),
+        0
+    )
+
+    with np.errstate(divide="ignore"):
+        df["dias_stock"] = np.where(media > 0, np.floor(stock / np.where(media > 0, media, 1)), np.inf)
+    df["demanda_diaria"] = media.round(2)
+    df["desviacion"] = desviacion.round(2)
+    df["stock_seguridad"] = stock_seguridad.astype(int)
+    df["punto_reorden"] = punto_reorden.astype(int)
+    df["cantidad_sugerida"] = np.maximum(cantidad, 0).astype(int)
+    df["costo_estimado"] = (df["cantidad_sugerida"] * df["precio_compra"]).round(2)
+    df["con_demanda"] = suma > 0
+    return df
+
+# Escritura en bloque: un solo UPDATE para todos los productos
+def aplicar_puntos_reorden(ids, puntos):
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE productos p
+            SET stock_minimo = s.punto
+            FROM unnest(%s::int[], %s::int[]) AS s(id, punto)
+            WHERE p.id = s.id AND p.stock_minimo IS DISTINCT FROM s.punto
+        """, (ids, puntos))
+        actualizados = cur.rowcount
+        conn.commit()
+        cur.close()
+        return actualizados
+    except Exception as e:
+        conn.rollback()
+        st.error(f"Error actualizando stock mínimo: {e}")
+        return None
+
 # Módulo de productos
+@medir_pagina("productos")
 def modulo_productos():
     st.title("📦 Gestión de Productos")
 
@@ -244,7 +913,8 @@ def modulo_productos():
 
     with tab1:
         st.subheader("Lista de Productos")
-        productos = ejecutar_sp("sp_obtener_productos")
+        productos = datos_compartidos("productos_lista", ("productos", "stock", "categorias"),
+                                      lambda: ejecutar_sp("sp_obtener_productos"))
         if productos:
             df = pd.DataFrame(productos, columns=['ID', 'Código', 'Nombre', 'Categoría', 'Precio', 'Stock'])
             st.dataframe(df, use_container_width=True)
@@ -260,7 +930,8 @@ def modulo_productos():
             with col1:
                 nombre = st.text_input("Nombre del Producto*")
                 descripcion = st.text_area("Descripción")
-                categorias = ejecutar_consulta("SELECT id, nombre FROM categorias")
+                categorias = datos_compartidos("categorias", ("categorias",),
+                                               lambda: ejecutar_consulta("SELECT id, nombre FROM categorias"))
                 categoria_opts = {cat[1]: cat[0] for cat in categorias} if categorias else {}
                 categoria = st.selectbox("Categoría", options=list(categoria_opts.keys()))
 
@@ -281,15 +952,78 @@ def modulo_productos():
                     """, (nombre, descripcion, categoria_id, marca, precio_compra, precio_venta, stock, stock_minimo))
                     #st.success("✅ Producto creado exitosamente")
                     st.session_state.mensaje_exito = "✅ Producto creado exitosamente"
+                    refrescar_versiones()
                     st.rerun()
                 else:
                     st.error("❌ Nombre y precio de venta son obligatorios")
 
-    #with tab3:
-        #st.subheader("Control de Inventario")
-        # Aquí puedes agregar funcionalidad para ajustes de inventario
+    with tab3:
+        st.subheader("Reposición Sugerida")
+
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            dias = st.selectbox("Historial (días)", DIAS_HISTORIA_REPOSICION, index=2)
+        with col2:
+            plazo_entrega = st.number_input("Plazo de entrega (días)", min_value=1, value=7)
+        with col3:
+            nivel_servicio = st.selectbox("Nivel de servicio", list(NIVELES_SERVICIO.keys()), index=1)
+        with col4:
+            dias_cobertura = st.number_input("Cobertura del pedido (días)", min_value=1, value=30)
+
+        if st.button("📊 Calcular Sugerencias", use_container_width=True):
+            inicio = time.perf_counter()
+            productos = ejecutar_consulta("""
+                SELECT id, nombre, stock_actual, stock_minimo, precio_compra
+                FROM productos
+                WHERE activo = true
+                ORDER BY id
+            """)
+            demanda = demanda_por_producto(dias)
+            if productos is not None and demanda is not None:
+                st.session_state.reposicion = calcular_reposicion(
+                    productos, demanda, dias, plazo_entrega, NIVELES_SERVICIO[nivel_servicio], dias_cobertura
+                )
+                st.session_state.reposicion_segundos = time.perf_counter() - inicio
+
+        reposicion = st.session_state.get("reposicion")
+        if reposicion is not None:
+            pedir = reposicion[reposicion["cantidad_sugerida"] > 0].sort_values("dias_stock")
+
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Productos a pedir", len(pedir))
+            col2.metric("Costo estimado", f"${pedir['costo_estimado'].sum():,.2f}")
+            col3.metric("Productos analizados", len(reposicion))
+            st.caption(f"Calculado en {st.session_state.reposicion_segundos:.2f} s")
+
+            mostrar = reposicion if st.checkbox("Mostrar todos los productos") else pedir
+            df = mostrar.drop(columns=["con_demanda"]).set_axis([
+                'ID', 'Nombre', 'Stock', 'Stock Mínimo', 'Precio Compra', 'Días de Stock', 'Demanda Diaria',
+                'Desviación', 'Stock Seguridad', 'Punto Reorden', 'Cantidad Sugerida', 'Costo Estimado'
+            ], axis=1)
+            st.dataframe(df, use_container_width=True, hide_index=True)
+
+            st.download_button(
+                "📥 Descargar Sugerencia de Compra",
+                pedir.drop(columns=["con_demanda"]).to_csv(index=False),
+                "sugerencia_compra.csv",
+                "text/csv",
+                use_container_width=True
+            )
+
+            # Solo productos con ventas en el período: el resto conserva su mínimo manual
+            if st.button("💾 Usar Punto de Reorden como Stock Mínimo", use_container_width=True):
+                con_demanda = reposicion[reposicion["con_demanda"]]
+                actualizados = aplicar_puntos_reorden(
+                    con_demanda["id"].tolist(), con_demanda["punto_reorden"].clip(lower=1).tolist()
+                )
+                if actualizados is not None:
+                    del st.session_state.reposicion
+                    st.session_state.mensaje_exito = f"✅ Stock mínimo actualizado en {actualizados} productos"
+                    refrescar_versiones()
+                    st.rerun()
 
 # Módulo de ventas
+@medir_pagina("ventas")
 def modulo_ventas():
     st.title("💰 Módulo de Ventas")
 
@@ -301,12 +1035,12 @@ def modulo_ventas():
         st.session_state.carrito = []
 
     # Obtener productos activos
-    productos = ejecutar_consulta("""
+    productos = datos_compartidos("productos_venta", ("productos", "stock"), lambda: ejecutar_consulta("""
         SELECT id, nombre, precio_venta, stock_actual
         FROM productos
         WHERE activo = true AND stock_actual > 0
         ORDER BY nombre
-    """)
+    """))
 
     if not productos:
         st.warning("No hay productos disponibles para la venta")
@@ -321,17 +1055,29 @@ def modulo_ventas():
     with col2:
         cantidad = st.number_input("Cantidad", min_value=1, value=1)
 
+    # Aviso de stock bajo desde el monitor en memoria (sin consultas adicionales)
+    monitor = monitor_stock_bajo_activo()
+    if monitor is not None:
+        bajo = monitor.esta_bajo(int(producto_sel.split('-')[0].strip()))
+        if bajo:
+            st.warning(f"⚠️ Stock bajo: quedan {bajo[2]} unidades (mínimo {bajo[3]})")
+
     if st.button("➕ Agregar al Carrito"):
         prod_id = int(producto_sel.split('-')[0].strip())
         nombre = producto_sel.split('-')[1].strip()
         precio = float(producto_sel.split('$')[1].split(' ')[0])
-        st.session_state.carrito.append({
-            "producto_id": prod_id,
-            "nombre": nombre,
-            "precio": precio,
-            "cantidad": cantidad
-        })
-        st.success(f"{nombre} agregado al carrito")
+        stock_disponible = next(p[3] for p in productos if p[0] == prod_id)
+        en_carrito = sum(i["cantidad"] for i in st.session_state.carrito if i["producto_id"] == prod_id)
+        if en_carrito + cantidad > stock_disponible:
+            st.error(f"❌ Stock insuficiente: disponible {stock_disponible}, en carrito {en_carrito}")
+        else:
+            st.session_state.carrito.append({
+                "producto_id": prod_id,
+                "nombre": nombre,
+                "precio": precio,
+                "cantidad": cantidad
+            })
+            st.success(f"{nombre} agregado al carrito")
 
     if st.session_state.carrito:
         df_carrito = pd.DataFrame(st.session_state.carrito)
@@ -341,29 +1087,145 @@ def modulo_ventas():
         st.metric("Total", f"${total:,.2f}")
 
         metodo_pago = st.selectbox("Método de Pago", ["Efectivo", "Tarjeta", "Transferencia"])
-        cliente_id = st.number_input("ID Cliente", min_value=1, value=1)
+        cliente_id = selector_cliente("cliente_venta", "Cliente", opcion_vacia=CONSUMIDOR_FINAL)
+        if not cliente_id:
+            st.caption("Sin cliente seleccionado: la venta se registrará con el cliente predeterminado (ID 1)")
+            cliente_id = 1
 
         if st.button("💳 Procesar Venta"):
             try:
-                detalles_json = json.dumps(st.session_state.carrito)
-                resultado = ejecutar_sp("sp_registrar_venta", (detalles_json, cliente_id, 1, metodo_pago))
+                with obtener_pool_ventas().conexion() as conexion:
+                    resultado, _ = registrar_venta_concurrente(
+                        conexion, st.session_state.carrito, cliente_id, 1, metodo_pago
+                    )
                 if resultado:
-                    venta_id = resultado[0][0]
-                    total_venta = resultado[0][2]
+                    venta_id = resultado[0]
+                    total_venta = resultado[2]
                     st.success(f"✅ Venta procesada! Total: ${total_venta:,.2f}")
 
                     pdf_data = generar_ticket(venta_id)
                     st.download_button("📥 Descargar Ticket", pdf_data, "ticket.pdf", "application/pdf")
 
                     st.session_state.carrito = []
+                    st.session_state.cliente_venta_limpiar = True
+                    refrescar_versiones()
                 else:
                     st.error("❌ No se pudo registrar la venta")
+            except StockInsuficiente as e:
+                st.error(f"❌ {e}")
             except Exception as e:
                 st.error(f"Ocurrió un error: {e}")
 
 
 
+# Selector de clientes: búsqueda indexada y acotada, con clientes recientes por sesión
+LIMITE_BUSQUEDA_CLIENTES = 20
+MAX_CLIENTES_RECIENTES = 8
+MIN_CARACTERES_BUSQUEDA = 3
+CONSUMIDOR_FINAL = "— Consumidor final —"
+
+def buscar_clientes(texto, solo_con_compras=False, limite=LIMITE_BUSQUEDA_CLIENTES):
+    patron = texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    query = """
+        SELECT id, cedula, nombre
+        FROM clientes
+        WHERE (cedula LIKE %s OR nombre ILIKE %s)
+    """
+    params = [f"{patron}%", f"%{patron}%"]
+
+    if solo_con_compras:
+        query += " AND EXISTS (SELECT 1 FROM ventas v WHERE v.cliente_id = clientes.id)"
+
+    query += " ORDER BY nombre LIMIT %s"
+    params.append(limite)
+    return ejecutar_consulta(query, params) or []
+
+# Un cliente entra en la lista de recientes solo cuando el usuario lo elige
+def recordar_cliente(clave, opciones):
+    cliente = opciones.get(st.session_state.get(f"{clave}_seleccion"))
+    if cliente:
+        recientes = st.session_state.setdefault("clientes_recientes", [])
+        recientes[:] = [cliente] + [c for c in recientes if c[0] != cliente[0]][:MAX_CLIENTES_RECIENTES - 1]
+
+# Con opcion_vacia la primera opción (por defecto) significa "sin cliente";
+# sin ella no hay selección hasta que el usuario elige uno
+def selector_cliente(clave, etiqueta, solo_con_compras=False, opcion_vacia=None):
+    recientes = st.session_state.setdefault("clientes_recientes", [])
+
+    # Tras usar el cliente (p. ej. al cerrar una venta) se limpia antes de crear los widgets
+    if st.session_state.pop(f"{clave}_limpiar", False):
+        st.session_state.pop(f"{clave}_busqueda", None)
+        st.session_state.pop(f"{clave}_seleccion", None)
+
+    texto = st.text_input("🔍 Buscar cliente por cédula o nombre", key=f"{clave}_busqueda").strip()
+
+    if len(texto) >= MIN_CARACTERES_BUSQUEDA:
+        resultados = buscar_clientes(texto, solo_con_compras)
+        if not resultados:
+            st.caption("Sin coincidencias")
+            return None
+    else:
+        resultados = recientes
+        if not resultados:
+            st.caption(f"Escribe al menos {MIN_CARACTERES_BUSQUEDA} caracteres para buscar")
+            return None
+        st.caption("Clientes recientes")
+
+    opciones = {f"{c[1]} - {c[2]}": tuple(c) for c in resultados}
+    seleccion = st.selectbox(
+        etiqueta,
+        options=([opcion_vacia] if opcion_vacia else []) + list(opciones.keys()),
+        index=0 if opcion_vacia else None,
+        placeholder="Elige un cliente",
+        key=f"{clave}_seleccion",
+        on_change=recordar_cliente,
+        args=(clave, opciones)
+    )
+    cliente = opciones.get(seleccion)
+    return cliente[0] if cliente else None
+
+# Historial de compras paginado por cursor (fecha_venta, id)
+TAMANO_PAGINA_HISTORIAL = 20
+
+def obtener_pagina_compras(cliente_id, cursor=None, tamano=TAMANO_PAGINA_HISTORIAL):
+    query = """
+        SELECT v.id, v.numero_factura, v.fecha_venta, v.total, v.metodo_pago,
+               (SELECT COUNT(*) FROM venta_detalles vd WHERE vd.venta_id = v.id) as items
+        FROM ventas v
+        WHERE v.cliente_id = %s
+    """
+    params = [cliente_id]
+
+    if cursor:
+        query += " AND (v.fecha_venta, v.id) < (%s, %s)"
+        params.extend(cursor)
+
+    query += " ORDER BY v.fecha_venta DESC, v.id DESC LIMIT %s"
+    params.append(tamano + 1)
+
+    filas = ejecutar_consulta(query, params) or []
+    return filas[:tamano], len(filas) > tamano
+
+# Serie mensual del cliente: desde el resumen precalculado si su trigger está
+# instalado (migrar_bd.py); si no, agregando sus ventas directamente
+def compras_mensuales_cliente(cliente_id):
+    if trigger_instalado("ventas", "trg_resumen_cliente_mensual"):
+        return ejecutar_consulta("""
+            SELECT mes, num_compras, total_mes
+            FROM resumen_cliente_mensual
+            WHERE cliente_id = %s AND num_compras > 0
+            ORDER BY mes
+        """, (cliente_id,))
+    return ejecutar_consulta("""
+        SELECT date_trunc('month', fecha_venta)::date AS mes, COUNT(*), COALESCE(SUM(total), 0)
+        FROM ventas
+        WHERE cliente_id = %s
+        GROUP BY mes
+        ORDER BY mes
+    """, (cliente_id,))
+
 # Celda: Módulo de Gestión de Clientes (agregar al archivo app_ferreteria.py)
+@medir_pagina("clientes")
 def modulo_clientes():
     st.title("👥 Gestión de Clientes")
 
@@ -471,6 +1333,7 @@ def modulo_clientes():
                             VALUES (%s, %s, %s, %s, %s)
                         """, (cedula, nombre, telefono, email, direccion))
                         st.success("✅ Cliente registrado exitosamente")
+                        refrescar_versiones()
                         st.rerun()
                 else:
                     st.error("❌ Cédula y Nombre son obligatorios")
@@ -479,132 +1342,507 @@ def modulo_clientes():
         st.subheader("✏️ Editar Información de Cliente")
 
         # Seleccionar cliente a editar
-        clientes_lista = ejecutar_consulta("SELECT id, cedula, nombre FROM clientes ORDER BY nombre")
-        if clientes_lista:
-            cliente_opts = {f"{c[1]} - {c[2]}": c[0] for c in clientes_lista}
-            cliente_seleccionado = st.selectbox("Seleccionar Cliente", options=list(cliente_opts.keys()))
-
-            if cliente_seleccionado:
-                cliente_id = cliente_opts[cliente_seleccionado]
-                cliente_data = ejecutar_consulta("SELECT * FROM clientes WHERE id = %s", (cliente_id,))
-
-                if cliente_data:
-                    with st.form("form_editar_cliente"):
-                        col1, col2 = st.columns(2)
-
-                        with col1:
-                            cedula_edit = st.text_input("Cédula", value=cliente_data[0][1], max_chars=13)
-                            nombre_edit = st.text_input("Nombre", value=cliente_data[0][2], max_chars=100)
-                            telefono_edit = st.text_input("Teléfono", value=cliente_data[0][3] or "", max_chars=15)
-
-                        with col2:
-                            email_edit = st.text_input("Email", value=cliente_data[0][4] or "", max_chars=100)
-                            direccion_edit = st.text_area("Dirección", value=cliente_data[0][5] or "", max_chars=200)
-
-                        if st.form_submit_button("💾 Actualizar Cliente", use_container_width=True):
-                            ejecutar_consulta("""
-                                UPDATE clientes
-                                SET cedula = %s, nombre = %s, telefono = %s,
-                                    email = %s, direccion = %s
-                                WHERE id = %s
-                            """, (cedula_edit, nombre_edit, telefono_edit, email_edit, direccion_edit, cliente_id))
-                            st.success("✅ Cliente actualizado exitosamente")
-                            st.rerun()
+        cliente_id = selector_cliente("cliente_editar", "Seleccionar Cliente")
+        if cliente_id:
+            cliente_data = ejecutar_consulta("SELECT * FROM clientes WHERE id = %s", (cliente_id,))
+
+            if cliente_data:
+                with st.form("form_editar_cliente"):
+                    col1, col2 = st.columns(2)
+
+                    with col1:
+                        cedula_edit = st.text_input("Cédula", value=cliente_data[0][1], max_chars=13)
+                        nombre_edit = st.text_input("Nombre", value=cliente_data[0][2], max_chars=100)
+                        telefono_edit = st.text_input("Teléfono", value=cliente_data[0][3] or "", max_chars=15)
+
+                    with col2:
+                        email_edit = st.text_input("Email", value=cliente_data[0][4] or "", max_chars=100)
+                        direccion_edit = st.text_area("Dirección", value=cliente_data[0][5] or "", max_chars=200)
+
+                    if st.form_submit_button("💾 Actualizar Cliente", use_container_width=True):
+                        ejecutar_consulta("""
+                            UPDATE clientes
+                            SET cedula = %s, nombre = %s, telefono = %s,
+                                email = %s, direccion = %s
+                            WHERE id = %s
+                        """, (cedula_edit, nombre_edit, telefono_edit, email_edit, direccion_edit, cliente_id))
+                        st.success("✅ Cliente actualizado exitosamente")
+                        refrescar_versiones()
+                        st.rerun()
         else:
-            st.info("No hay clientes registrados para editar")
+            st.info("Busca un cliente por cédula o nombre para editarlo")
 
     with tab4:
         st.subheader("📋 Historial de Compras por Cliente")
 
-        clientes_compras = ejecutar_consulta("""
-            SELECT id, cedula, nombre FROM clientes
-            WHERE id IN (SELECT DISTINCT cliente_id FROM ventas WHERE cliente_id IS NOT NULL)
-            ORDER BY nombre
-        """)
+        cliente_id_hist = selector_cliente(
+            "cliente_historial", "Seleccionar Cliente para ver historial", solo_con_compras=True
+        )
+
+        if cliente_id_hist:
+            # Estadísticas y gráfico desde la serie mensual
+            compras_mes = compras_mensuales_cliente(cliente_id_hist)
+
+            if compras_mes:
+                df_mes = pd.DataFrame(compras_mes, columns=['Mes', 'Número Compras', 'Total Mes'])
 
-        if clientes_compras:
-            cliente_hist_opts = {f"{c[1]} - {c[2]}": c[0] for c in clientes_compras}
-            cliente_hist = st.selectbox("Seleccionar Cliente para ver historial", options=list(cliente_hist_opts.keys()))
-
-            if cliente_hist:
-                cliente_id_hist = cliente_hist_opts[cliente_hist]
-
-                # Obtener historial de compras
-                compras = ejecutar_consulta("""
-                    SELECT v.id, v.numero_factura, v.fecha_venta, v.total, v.metodo_pago,
-                           COUNT(vd.id) as items,
-                           STRING_AGG(p.nombre, ', ') as productos
-                    FROM ventas v
-                    LEFT JOIN venta_detalles vd ON v.id = vd.venta_id
-                    LEFT JOIN productos p ON vd.producto_id = p.id
-                    WHERE v.cliente_id = %s
-                    GROUP BY v.id, v.numero_factura, v.fecha_venta, v.total, v.metodo_pago
-                    ORDER BY v.fecha_venta DESC
-                """, (cliente_id_hist,))
+                # Estadísticas del cliente
+                total_gastado = float(df_mes['Total Mes'].sum())
+                total_compras = int(df_mes['Número Compras'].sum())
+                promedio_compra = total_gastado / total_compras if total_compras > 0 else 0
+
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Total Gastado", f"${total_gastado:,.2f}")
+                col2.metric("Total Compras", total_compras)
+                col3.metric("Promedio por Compra", f"${promedio_compra:,.2f}")
+
+                # Paginación por cursor (fecha_venta, id): se reinicia al cambiar de cliente
+                if st.session_state.get("historial_cliente") != cliente_id_hist:
+                    st.session_state.historial_cliente = cliente_id_hist
+                    st.session_state.historial_cursores = [None]
+
+                cursores = st.session_state.historial_cursores
+                compras, hay_siguiente = obtener_pagina_compras(cliente_id_hist, cursores[-1])
 
                 if compras:
                     df_compras = pd.DataFrame(compras, columns=[
-                        'ID', 'Factura', 'Fecha', 'Total', 'Método Pago', 'Items', 'Productos'
+                        'ID', 'Factura', 'Fecha', 'Total', 'Método Pago', 'Items'
                     ])
                     df_compras['Fecha'] = pd.to_datetime(df_compras['Fecha']).dt.strftime('%Y-%m-%d %H:%M')
 
-                    # Estadísticas del cliente
-                    total_gastado = df_compras['Total'].sum()
-                    total_compras = len(compras)
-                    promedio_compra = total_gastado / total_compras if total_compras > 0 else 0
-
-                    col1, col2, col3 = st.columns(3)
-                    col1.metric("Total Gastado", f"${total_gastado:,.2f}")
-                    col2.metric("Total Compras", total_compras)
-                    col3.metric("Promedio por Compra", f"${promedio_compra:,.2f}")
-
                     st.dataframe(
                         df_compras,
                         column_config={
-                            "Total": st.column_config.NumberColumn(format="$%.2f"),
-                            "Productos": st.column_config.TextColumn(width="large")
+                            "Total": st.column_config.NumberColumn(format="$%.2f")
                         },
                         use_container_width=True,
                         hide_index=True
                     )
 
-                    # Gráfico de compras por mes
-                    st.subheader("📈 Compras por Mes")
-                    compras_mes = ejecutar_consulta("""
-                        SELECT DATE_TRUNC('month', fecha_venta) as mes,
-                               COUNT(*) as num_compras,
-                               SUM(total) as total_mes
-                        FROM ventas
-                        WHERE cliente_id = %s
-                        GROUP BY DATE_TRUNC('month', fecha_venta)
-                        ORDER BY mes
-                    """, (cliente_id_hist,))
-
-                    if compras_mes:
-                        df_mes = pd.DataFrame(compras_mes, columns=['Mes', 'Número Compras', 'Total Mes'])
-                        df_mes['Mes'] = pd.to_datetime(df_mes['Mes']).dt.strftime('%Y-%m')
-
-                        fig = make_subplots(specs=[[{"secondary_y": True}]])
-                        fig.add_trace(
-                            go.Bar(x=df_mes['Mes'], y=df_mes['Número Compras'], name="Número de Compras"),
-                            secondary_y=False,
-                        )
-                        fig.add_trace(
-                            go.Scatter(x=df_mes['Mes'], y=df_mes['Total Mes'], name="Total Gastado", mode='lines+markers'),
-                            secondary_y=True,
-                        )
-                        fig.update_layout(title_text="Evolución de Compras")
-                        fig.update_xaxes(title_text="Mes")
-                        fig.update_yaxes(title_text="Número de Compras", secondary_y=False)
-                        fig.update_yaxes(title_text="Total Gastado ($)", secondary_y=True)
-
-                        st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.info("Este cliente no tiene compras registradas")
+                    col1, col2, col3 = st.columns([1, 2, 1])
+                    with col1:
+                        if st.button("⬅️ Anterior", disabled=len(cursores) == 1, use_container_width=True):
+                            cursores.pop()
+                            st.rerun()
+                    with col2:
+                        st.caption(f"Página {len(cursores)} · {TAMANO_PAGINA_HISTORIAL} compras por página")
+                    with col3:
+                        if st.button("Siguiente ➡️", disabled=not hay_siguiente, use_container_width=True):
+                            ultima = compras[-1]
+                            cursores.append((ultima[2], ultima[0]))
+                            st.rerun()
+
+                    # Los productos de una factura se cargan solo al seleccionarla
+                    factura_opts = {f"{c[1]} - {pd.to_datetime(c[2]):%Y-%m-%d %H:%M}": c[0] for c in compras}
+                    factura_sel = st.selectbox(
+                        "🔎 Ver productos de la factura",
+                        options=["—"] + list(factura_opts.keys())
+                    )
+                    if factura_sel != "—":
+                        detalles = ejecutar_consulta("""
+                            SELECT p.nombre, vd.cantidad, vd.precio, vd.cantidad * vd.precio as subtotal
+                            FROM venta_detalles vd
+                            JOIN productos p ON vd.producto_id = p.id
+                            WHERE vd.venta_id = %s
+                        """, (factura_opts[factura_sel],))
+                        if detalles:
+                            df_detalles = pd.DataFrame(detalles, columns=['Producto', 'Cantidad', 'Precio', 'Subtotal'])
+                            st.dataframe(df_detalles, use_container_width=True, hide_index=True)
+                        else:
+                            st.info("La factura no tiene productos registrados")
+
+                # Gráfico de compras por mes
+                st.subheader("📈 Compras por Mes")
+                df_mes['Mes'] = pd.to_datetime(df_mes['Mes']).dt.strftime('%Y-%m')
+
+                with tramo("chart"):
+                    fig = make_subplots(specs=[[{"secondary_y": True}]])
+                    fig.add_trace(
+                        go.Bar(x=df_mes['Mes'], y=df_mes['Número Compras'], name="Número de Compras"),
+                        secondary_y=False,
+                    )
+                    fig.add_trace(
+                        go.Scatter(x=df_mes['Mes'], y=df_mes['Total Mes'], name="Total Gastado", mode='lines+markers'),
+                        secondary_y=True,
+                    )
+                    fig.update_layout(title_text="Evolución de Compras")
+                    fig.update_xaxes(title_text="Mes")
+                    fig.update_yaxes(title_text="Número de Compras", secondary_y=False)
+                    fig.update_yaxes(title_text="Total Gastado ($)", secondary_y=True)
+
+                st.plotly_chart(fig, use_container_width=True)
+            else:
+                st.info("Este cliente no tiene compras registradas")
         else:
-            st.info("No hay clientes con historial de compras")
+            st.info("Busca un cliente con compras para ver su historial")
+
+# Caché persistente de reportes: los meses cerrados no cambian, así que sus
+# parciales diarios se guardan en Parquet y solo el mes abierto se consulta en vivo
+DIRECTORIO_CACHE_REPORTES = Path(configuracion("CACHE_REPORTES_DIR", ".cache_reportes"))
+# Un mes se da por cerrado unos días después de terminar (ventas tardías o relojes desfasados)
+DIAS_GRACIA_CIERRE_MES = int(configuracion("DIAS_GRACIA_CIERRE_MES", 2))
+
+REPORTES_CACHEABLES = {
+    "ventas_periodo": {
+        "consulta": """
+            SELECT fecha_venta::date as fecha,
+                   COUNT(*) as numero_ventas,
+                   COALESCE(SUM(total), 0) as total_ventas
+            FROM ventas
+            WHERE fecha_venta >= %s AND fecha_venta < %s
+            GROUP BY 1
+        """,
+        "columnas": ["fecha", "numero_ventas", "total_ventas"],
+        "numericas": ["numero_ventas", "total_ventas"],
+    },
+    "ventas_metodo_pago": {
+        "consulta": """
+            SELECT fecha_venta::date as fecha, metodo_pago,
+                   COUNT(*) as numero_ventas,
+                   COALESCE(SUM(total), 0) as total_ventas
+            FROM ventas
+            WHERE fecha_venta >= %s AND fecha_venta < %s
+            GROUP BY 1, 2
+        """,
+        "columnas": ["fecha", "metodo_pago", "numero_ventas", "total_ventas"],
+        "numericas": ["numero_ventas", "total_ventas"],
+    },
+    "top_productos": {
+        "consulta": """
+            SELECT v.fecha_venta::date as fecha, p.nombre as producto,
+                   SUM(vd.cantidad) as cantidad,
+                   SUM(vd.cantidad * vd.precio) as ingresos
+            FROM venta_detalles vd
+            JOIN productos p ON vd.producto_id = p.id
+            JOIN ventas v ON vd.venta_id = v.id
+            WHERE v.fecha_venta >= %s AND v.fecha_venta < %s
+            GROUP BY 1, 2
+        """,
+        "columnas": ["fecha", "producto", "cantidad", "ingresos"],
+        "numericas": ["cantidad", "ingresos"],
+    },
+}
+
+def ruta_particion(tipo, mes):
+    return DIRECTORIO_CACHE_REPORTES / tipo / f"{mes}.parquet"
+
+def consultar_parciales(tipo, desde, hasta):
+    reporte = REPORTES_CACHEABLES[tipo]
+    filas = ejecutar_consulta(reporte["consulta"], (desde, hasta))
+    if filas is None:
+        return None
+    df = pd.DataFrame(filas, columns=reporte["columnas"])
+    df["fecha"] = pd.to_datetime(df["fecha"])
+    df[reporte["numericas"]] = df[reporte["numericas"]].astype(float)
+    return df
+
+def leer_particion(tipo, mes):
+    ruta = ruta_particion(tipo, mes)
+    try:
+        return pd.read_parquet(ruta)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Archivo dañado: se descarta y se recalcula
+        ruta.unlink(missing_ok=True)
+        return None
+
+def guardar_particion(tipo, mes, df):
+    ruta = ruta_particion(tipo, mes)
+    try:
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_suffix(f".{os.getpid()}.tmp")
+        df.to_parquet(temporal, index=False, compression="zstd")
+        os.replace(temporal, ruta)
+    except Exception as e:
+        st.warning(f"No se pudo guardar la caché de {tipo} {mes}: {e}")
+
+@tramo("transform")
+# La fecha sale de la base: los días se agrupan con fecha_venta::date en su zona horaria
+def fecha_base():
+    hoy = ejecutar_consulta("SELECT CURRENT_DATE")
+    return hoy[0][0] if hoy else None
+
+# Quien pide varios reportes en el mismo rerun pasa "hoy" para leer la fecha una sola vez
+def obtener_parciales_diarios(tipo, fecha_inicio, fecha_fin, hoy=None):
+    hoy = hoy or fecha_base()
+    if hoy is None:
+        return None
+    inicio_mes_abierto = (hoy - timedelta(days=DIAS_GRACIA_CIERRE_MES)).replace(day=1)
+    ultimo_dia_cerrado = min(fecha_fin, inicio_mes_abierto - timedelta(days=1))
+    partes = []
+
+    # Meses cerrados: desde la caché, calculando de una vez los que falten
+    if fecha_inicio <= ultimo_dia_cerrado:
+        faltantes = []
+        for mes in pd.period_range(fecha_inicio, ultimo_dia_cerrado, freq="M"):
+            df_mes = leer_particion(tipo, mes)
+            if df_mes is None:
+                faltantes.append(mes)
+            else:
+                partes.append(df_mes)
+
+        if faltantes:
+            df_nuevo = consultar_parciales(tipo, faltantes[0].start_time.date(), (faltantes[-1] + 1).start_time.date())
+            if df_nuevo is None:
+                return None
+            meses_nuevo = df_nuevo["fecha"].dt.to_period("M")
+            for mes in faltantes:
+                df_mes = df_nuevo[meses_nuevo == mes].reset_index(drop=True)
+                guardar_particion(tipo, mes, df_mes)
+                partes.append(df_mes)
+
+    # Mes abierto: consulta en vivo solo del tramo final
+    if fecha_fin >= inicio_mes_abierto:
+        df_vivo = consultar_parciales(tipo, max(fecha_inicio, inicio_mes_abierto), fecha_fin + timedelta(days=1))
+        if df_vivo is None:
+            return None
+        partes.append(df_vivo)
+
+    partes = [p for p in partes if not p.empty]
+    if not partes:
+        return pd.DataFrame(columns=REPORTES_CACHEABLES[tipo]["columnas"])
+
+    df = pd.concat(partes, ignore_index=True)
+    return df[(df["fecha"] >= pd.Timestamp(fecha_inicio)) & (df["fecha"] <= pd.Timestamp(fecha_fin))]
+
+# Para correcciones con fecha pasada: borra los meses afectados de todos los reportes
+def invalidar_cache_reportes(desde, hasta):
+    eliminados = 0
+    for tipo in REPORTES_CACHEABLES:
+        for mes in pd.period_range(desde, hasta, freq="M"):
+            ruta = ruta_particion(tipo, mes)
+            if ruta.exists():
+                ruta.unlink()
+                eliminados += 1
+    return eliminados
+
+# Agrupación temporal y reducción de puntos para gráficos de ventas
+PUNTOS_MAX_GRAFICO = 400
+
+GRANULARIDADES = [
+    ("day", "Día", 1),
+    ("week", "Semana", 7),
+    ("month", "Mes", 30),
+    ("quarter", "Trimestre", 91),
+]
+
+def elegir_granularidad(fecha_inicio, fecha_fin, max_puntos=PUNTOS_MAX_GRAFICO):
+    dias = (fecha_fin - fecha_inicio).days + 1
+    for unidad, nombre, dias_unidad in GRANULARIDADES:
+        if dias / dias_unidad <= max_puntos:
+            return unidad, nombre
+    return GRANULARIDADES[-1][0], GRANULARIDADES[-1][1]
+
+FRECUENCIAS_PANDAS = {"day": "D", "week": "W", "month": "M", "quarter": "Q"}
+
+# Agrupa los parciales diarios en caché en lugar de hacer date_trunc en SQL: los meses
+# cerrados no vuelven a la base y, a cambio, se agrupan como mucho unas pocas
+# filas por día en pandas (rangos de varios años siguen siendo pocos miles de filas)
+@tramo("transform")
+def ventas_agrupadas(parciales, unidad):
+    if parciales is None or parciales.empty:
+        return None
+
+    # Mismos cortes que date_trunc: semanas desde el lunes, trimestres calendario
+    periodo = parciales["fecha"].dt.to_period(FRECUENCIAS_PANDAS[unidad]).dt.start_time.rename("periodo")
+    df = parciales.groupby(periodo)[["numero_ventas", "total_ventas"]].sum().reset_index()
+    df["numero_ventas"] = df["numero_ventas"].astype(int)
+    df["promedio_venta"] = df["total_ventas"] / df["numero_ventas"]
+    return df
+
+# Conserva el mínimo y el máximo de cada segmento para no perder picos al reducir la serie.
+# Las series agrupadas con elegir_granularidad ya caben en PUNTOS_MAX_GRAFICO (salvo
+# rangos de más de un siglo): aquí queda como límite de seguridad antes de graficar.
+@tramo("transform")
+def reducir_serie_min_max(df, columna_y, max_puntos=PUNTOS_MAX_GRAFICO):
+    n = len(df)
+    if n <= max_puntos:
+        return df
+
+    # Mínimo y máximo por segmento más el primer y último punto: no pasa de max_puntos
+    segmentos = max((max_puntos - 2) // 2, 1)
+    valores = pd.to_numeric(df[columna_y], errors="coerce").astype(float).to_numpy()
+    bordes = np.linspace(0, n, segmentos + 1).astype(int)
+    segmento = np.repeat(np.arange(segmentos), np.diff(bordes))
+
+    # Orden por (segmento, valor): el primero de cada segmento es el mínimo y el último el máximo
+    orden = np.lexsort((valores, segmento))
+    minimos = orden[bordes[:-1]]
+    maximos = orden[bordes[1:] - 1]
+
+    indices = np.unique(np.concatenate([minimos, maximos, [0, n - 1]]))
+    return df.iloc[indices]
+
+# Comparación de períodos: el actual, el inmediatamente anterior de igual duración
+# y el mismo rango del año pasado
+def periodos_comparacion(fecha_inicio, fecha_fin):
+    dias = (fecha_fin - fecha_inicio).days + 1
+    un_anio = pd.DateOffset(years=1)
+    return {
+        "Actual": (fecha_inicio, fecha_fin),
+        "Período Anterior": (fecha_inicio - timedelta(days=dias), fecha_inicio - timedelta(days=1)),
+        "Año Anterior": ((pd.Timestamp(fecha_inicio) - un_anio).date(), (pd.Timestamp(fecha_fin) - un_anio).date()),
+    }
+
+# Clientes distintos por período en una sola consulta: meses completos desde
+# resumen_cliente_mensual y solo los días sueltos de los extremos desde ventas.
+# Sin el trigger del resumen (migrar_bd.py) todo el rango sale de ventas.
+def clientes_activos_periodos(periodos):
+    valores = ", ".join(["(%s, %s::date, %s::date + 1)"] * len(periodos))
+    params = [v for nombre, (desde, hasta) in periodos.items() for v in (nombre, desde, hasta)]
+    if not trigger_instalado("ventas", "trg_resumen_cliente_mensual"):
+        return ejecutar_consulta(f"""
+            WITH periodos(periodo, desde, fin) AS (VALUES {valores})
+            SELECT p.periodo, COUNT(DISTINCT v.cliente_id)
+            FROM periodos p
+            LEFT JOIN ventas v ON v.fecha_venta >= p.desde AND v.fecha_venta < p.fin
+            GROUP BY p.periodo
+        """, params)
+    return ejecutar_consulta(f"""
+        WITH periodos(periodo, desde, fin) AS (VALUES {valores}),
+        rangos AS (
+            SELECT periodo, desde, fin,
+                   CASE WHEN desde = date_trunc('month', desde)::date THEN desde
+                        ELSE (date_trunc('month', desde) + INTERVAL '1 month')::date END AS ini_mes,
+                   date_trunc('month', fin)::date AS fin_mes
+            FROM periodos
+        )
+        SELECT r.periodo, COUNT(DISTINCT x.cliente_id)
+        FROM rangos r
+        LEFT JOIN LATERAL (
+            SELECT cliente_id FROM resumen_cliente_mensual
+            WHERE mes >= r.ini_mes AND mes < r.fin_mes AND num_compras > 0
+            UNION ALL
+            SELECT cliente_id FROM ventas
+            WHERE fecha_venta >= r.desde AND fecha_venta < LEAST(r.ini_mes, r.fin)
+            UNION ALL
+            SELECT cliente_id FROM ventas
+            WHERE fecha_venta >= GREATEST(r.fin_mes, r.ini_mes) AND fecha_venta < r.fin
+        ) x ON true
+        GROUP BY r.periodo
+    """, params)
+
+# Ingresos y tickets salen de los parciales diarios de cada período (ver
+# parciales_periodos), que el llamador reutiliza para el gráfico del actual
+def metricas_periodos(periodos, diarios):
+    if any(diario is None for diario in diarios.values()):
+        return None
+    clientes = clientes_activos_periodos(periodos)
+    if clientes is None:
+        return None
+    clientes = dict(clientes)
+
+    filas = []
+    for nombre, (desde, hasta) in periodos.items():
+        diario = diarios[nombre]
+        tickets = int(diario["numero_ventas"].sum())
+        ingresos = float(diario["total_ventas"].sum())
+        filas.append({
+            "Período": nombre,
+            "Desde": desde,
+            "Hasta": hasta,
+            "Ingresos": ingresos,
+            "Tickets": tickets,
+            "Ticket Promedio": ingresos / tickets if tickets else 0.0,
+            "Clientes Activos": clientes.get(nombre, 0),
+        })
+    return pd.DataFrame(filas).set_index("Período")
+
+# Desde la caché de meses cerrados: cada período solo consulta en vivo lo que caiga en el mes abierto
+def parciales_periodos(periodos, hoy):
+    return {nombre: obtener_parciales_diarios("ventas_periodo", desde, hasta, hoy)
+            for nombre, (desde, hasta) in periodos.items()}
+
+def variacion(actual, anterior):
+    return (actual - anterior) / anterior * 100 if anterior else None
+
+# Consultas personalizadas: conexión propia de corta vida, en solo lectura y con
+# límites de tiempo, para que una exploración no retenga bloqueos ni frene el cobro
+SQL_TIMEOUT_MS = int(configuracion("SQL_TIMEOUT_MS", 15000))
+SQL_LOCK_TIMEOUT_MS = int(configuracion("SQL_LOCK_TIMEOUT_MS", 1000))
+SQL_MAX_FILAS = int(configuracion("SQL_MAX_FILAS", 10000))
+SQL_COSTO_MAX = float(configuracion("SQL_COSTO_MAX", 1_000_000))
+MODOS_CONSULTA = ["Ejecutar", "Explain (ANALYZE, BUFFERS)"]
+
+# Cadenas, identificadores entre comillas y comentarios: los ";" dentro de ellos no separan sentencias
+TOKENS_SQL = re.compile(r"""
+    '(?:[^']|'')*'
+  | "(?:[^"]|"")*"
+  | \$(\w*)\$.*?\$\1\$
+  | --[^\n]*
+  | /\*.*?\*/
+  | ;
+""", re.S | re.X)
+
+# Devuelve la única sentencia del texto, o None si trae más de una
+def sentencia_unica(texto):
+    partes, inicio = [], 0
+    for token in TOKENS_SQL.finditer(texto):
+        if token.group(0) == ";":
+            partes.append(texto[inicio:token.start()])
+            inicio = token.end()
+    partes.append(texto[inicio:])
+
+    def solo_comentarios(parte):
+        return not TOKENS_SQL.sub(lambda t: "" if t.group(0).startswith(("--", "/*")) else t.group(0), parte).strip()
+
+    sentencias = [parte.strip() for parte in partes if not solo_comentarios(parte)]
+    return sentencias[0] if len(sentencias) == 1 else None
+
+def conexion_solo_lectura():
+    # Los límites van a nivel de sesión: siguen vigentes aunque la consulta incluya un COMMIT
+    conexion = psycopg2.connect(
+        **parametros_conexion(),
+        options=f"-c default_transaction_read_only=on -c statement_timeout={SQL_TIMEOUT_MS} "
+                f"-c lock_timeout={SQL_LOCK_TIMEOUT_MS}"
+    )
+    conexion.set_session(readonly=True)
+    return conexion
+
+# Recorre el plan de EXPLAIN ANALYZE; el tiempo exclusivo descuenta el de los nodos hijos
+def nodos_plan(plan, profundidad=0):
+    hijos = plan.get("Plans", [])
+    total = plan.get("Actual Total Time", 0) * plan.get("Actual Loops", 1)
+    exclusivo = total - sum(h.get("Actual Total Time", 0) * h.get("Actual Loops", 1) for h in hijos)
+    nombre = plan["Node Type"] + (f" en {plan['Relation Name']}" if "Relation Name" in plan else "")
+
+    nodos = [{
+        "Nodo": "   " * profundidad + nombre,
+        "Costo": plan.get("Total Cost"),
+        "Filas Est.": plan.get("Plan Rows"),
+        "Filas Reales": plan.get("Actual Rows"),
+        "Loops": plan.get("Actual Loops"),
+        "Tiempo Total (ms)": round(total, 3),
+        "Tiempo Exclusivo (ms)": round(max(exclusivo, 0), 3),
+        "Buffers Hit": plan.get("Shared Hit Blocks"),
+        "Buffers Leídos": plan.get("Shared Read Blocks"),
+    }]
+    for hijo in hijos:
+        nodos += nodos_plan(hijo, profundidad + 1)
+    return nodos
+
+def mostrar_plan(explain):
+    col1, col2 = st.columns(2)
+    col1.metric("Planificación", f"{explain.get('Planning Time', 0):,.2f} ms")
+    col2.metric("Ejecución", f"{explain.get('Execution Time', 0):,.2f} ms")
+
+    df_plan = pd.DataFrame(nodos_plan(explain["Plan"]))
+    mas_costoso = df_plan["Tiempo Exclusivo (ms)"].idxmax()
+    st.warning(f"🔥 Nodo más costoso: {df_plan.at[mas_costoso, 'Nodo'].strip()} "
+               f"({df_plan.at[mas_costoso, 'Tiempo Exclusivo (ms)']:,.2f} ms exclusivos)")
+    st.dataframe(
+        df_plan.style.apply(
+            lambda fila: ["background-color: #ffcccc" if fila.name == mas_costoso else ""] * len(fila), axis=1
+        ),
+        use_container_width=True,
+        hide_index=True
+    )
+    with st.expander("Plan completo (JSON)"):
+        st.json(explain)
 
 # Celda: Módulo de Reportes (agregar al archivo app_ferreteria.py)
+@medir_pagina("reportes")
 def modulo_reportes():
     st.title("📊 Reportes Avanzados")
 
@@ -627,54 +1865,58 @@ def modulo_reportes():
             fecha_fin = st.date_input("Fecha Fin", value=pd.to_datetime("today"))
 
         if st.button("🔄 Generar Reporte", use_container_width=True):
-            # Métricas principales
-            metricas = ejecutar_consulta("""
-                SELECT
-                    COUNT(*) as total_ventas,
-                    COALESCE(SUM(total), 0) as total_ingresos,
-                    COALESCE(AVG(total), 0) as promedio_venta,
-                    COUNT(DISTINCT cliente_id) as clientes_activos
-                FROM ventas
-                WHERE fecha_venta::date BETWEEN %s AND %s
-            """, (fecha_inicio, fecha_fin))
-
-            if metricas:
-                col1, col2, col3, col4 = st.columns(4)
-                col1.metric("Total Ventas", metricas[0][0])
-                col2.metric("Ingresos Totales", f"${metricas[0][1]:,.2f}")
-                col3.metric("Promedio por Venta", f"${metricas[0][2]:,.2f}")
-                col4.metric("Clientes Activos", metricas[0][3])
-
-            # Gráfico de ventas por día
-            ventas_dia = ejecutar_consulta("""
-                SELECT fecha_venta::date as fecha, SUM(total) as total_dia
-                FROM ventas
-                WHERE fecha_venta::date BETWEEN %s AND %s
-                GROUP BY fecha_venta::date
-                ORDER BY fecha
-            """, (fecha_inicio, fecha_fin))
-
-            if ventas_dia:
-                df_ventas_dia = pd.DataFrame(ventas_dia, columns=['Fecha', 'Total'])
-                fig = px.line(df_ventas_dia, x='Fecha', y='Total', title='Ventas Diarias')
+            # Métricas principales con variación frente al período anterior; los
+            # parciales del período actual se reutilizan en el gráfico
+            hoy = fecha_base()
+            periodos = periodos_comparacion(fecha_inicio, fecha_fin)
+            diarios = parciales_periodos(periodos, hoy)
+            metricas = metricas_periodos(periodos, diarios)
+
+            if metricas is not None:
+                actual, anterior, anio_anterior = (metricas.loc[p] for p in metricas.index)
+                formatos = {
+                    "Tickets": ("Total Ventas", "{:,.0f}"),
+                    "Ingresos": ("Ingresos Totales", "${:,.2f}"),
+                    "Ticket Promedio": ("Promedio por Venta", "${:,.2f}"),
+                    "Clientes Activos": ("Clientes Activos", "{:,.0f}"),
+                }
+                for col, (campo, (etiqueta, formato)) in zip(st.columns(4), formatos.items()):
+                    delta = variacion(actual[campo], anterior[campo])
+                    col.metric(etiqueta, formato.format(actual[campo]),
+                               f"{delta:+.1f}% vs período anterior" if delta is not None else None)
+
+                comparacion = pd.DataFrame({
+                    "Actual": actual[list(formatos)],
+                    "Período Anterior": anterior[list(formatos)],
+                    "Δ% Anterior": [variacion(actual[c], anterior[c]) for c in formatos],
+                    "Año Anterior": anio_anterior[list(formatos)],
+                    "Δ% Año Anterior": [variacion(actual[c], anio_anterior[c]) for c in formatos],
+                }).rename(index={c: e for c, (e, _) in formatos.items()})
+                st.caption(f"Período anterior: {anterior['Desde']} a {anterior['Hasta']} · "
+                           f"Año anterior: {anio_anterior['Desde']} a {anio_anterior['Hasta']}")
+                st.dataframe(comparacion.style.format("{:,.2f}", na_rep="—"), use_container_width=True)
+
+            # Gráfico de ventas agrupado según el rango seleccionado
+            unidad, nombre_unidad = elegir_granularidad(fecha_inicio, fecha_fin)
+            ventas_periodo = ventas_agrupadas(diarios["Actual"], unidad)
+
+            if ventas_periodo is not None:
+                df_ventas_periodo = ventas_periodo.set_axis(['Fecha', 'Número Ventas', 'Total', 'Promedio'], axis=1)
+                df_ventas_periodo = reducir_serie_min_max(df_ventas_periodo, 'Total')
+                with tramo("chart"):
+                    fig = px.line(df_ventas_periodo, x='Fecha', y='Total', title=f'Ventas por {nombre_unidad}')
                 st.plotly_chart(fig, use_container_width=True)
 
             # Top 5 productos más vendidos
-            top_productos = ejecutar_consulta("""
-                SELECT p.nombre, SUM(vd.cantidad) as total_vendido, SUM(vd.cantidad * vd.precio) as ingresos
-                FROM venta_detalles vd
-                JOIN productos p ON vd.producto_id = p.id
-                JOIN ventas v ON vd.venta_id = v.id
-                WHERE v.fecha_venta::date BETWEEN %s AND %s
-                GROUP BY p.nombre
-                ORDER BY total_vendido DESC
-                LIMIT 5
-            """, (fecha_inicio, fecha_fin))
-
-            if top_productos:
+            top_productos = obtener_parciales_diarios("top_productos", fecha_inicio, fecha_fin, hoy)
+
+            if top_productos is not None and not top_productos.empty:
                 st.subheader("🏆 Top 5 Productos Más Vendidos")
-                df_top = pd.DataFrame(top_productos, columns=['Producto', 'Cantidad', 'Ingresos'])
-                fig = px.bar(df_top, x='Producto', y='Cantidad', title='Cantidad Vendida por Producto')
+                df_top = (top_productos.groupby("producto")[["cantidad", "ingresos"]].sum()
+                          .nlargest(5, "cantidad").reset_index())
+                df_top.columns = ['Producto', 'Cantidad', 'Ingresos']
+                with tramo("chart"):
+                    fig = px.bar(df_top, x='Producto', y='Cantidad', title='Cantidad Vendida por Producto')
                 st.plotly_chart(fig, use_container_width=True)
 
     with tab2:
@@ -694,19 +1936,19 @@ def modulo_reportes():
 
         if st.button("📊 Generar Reporte Ventas", use_container_width=True):
             if reporte_tipo == "Ventas por Período":
-                datos = ejecutar_consulta("""
-                    SELECT fecha_venta::date as fecha,
-                           COUNT(*) as numero_ventas,
-                           SUM(total) as total_ventas,
-                           AVG(total) as promedio_venta
-                    FROM ventas
-                    WHERE fecha_venta::date BETWEEN %s AND %s
-                    GROUP BY fecha_venta::date
-                    ORDER BY fecha
-                """, (fecha_inicio_ventas, fecha_fin_ventas))
-
-                if datos:
-                    df = pd.DataFrame(datos, columns=['Fecha', 'Número Ventas', 'Total Ventas', 'Promedio Venta'])
+                # Tabla y CSV siempre diarios; solo el gráfico se agrupa según el rango
+                unidad, nombre_unidad = elegir_granularidad(fecha_inicio_ventas, fecha_fin_ventas)
+                parciales = obtener_parciales_diarios("ventas_periodo", fecha_inicio_ventas, fecha_fin_ventas)
+                datos = ventas_agrupadas(parciales, "day")
+
+                if datos is not None:
+                    columnas = ['Fecha', 'Número Ventas', 'Total Ventas', 'Promedio Venta']
+                    df = datos.set_axis(columnas, axis=1)
+                    df_grafico = df if unidad == "day" else ventas_agrupadas(parciales, unidad).set_axis(columnas, axis=1)
+                    with tramo("chart"):
+                        fig = px.line(reducir_serie_min_max(df_grafico, 'Total Ventas'), x='Fecha', y='Total Ventas',
+                                      title=f'Ventas por {nombre_unidad}')
+                    st.plotly_chart(fig, use_container_width=True)
                     st.dataframe(df, use_container_width=True)
 
                     # Exportar a CSV
@@ -720,21 +1962,55 @@ def modulo_reportes():
                     )
 
             elif reporte_tipo == "Ventas por Método de Pago":
-                datos = ejecutar_consulta("""
-                    SELECT metodo_pago,
-                           COUNT(*) as numero_ventas,
-                           SUM(total) as total_ventas
-                    FROM ventas
-                    WHERE fecha_venta::date BETWEEN %s AND %s
-                    GROUP BY metodo_pago
-                    ORDER BY total_ventas DESC
-                """, (fecha_inicio_ventas, fecha_fin_ventas))
-
-                if datos:
-                    df = pd.DataFrame(datos, columns=['Método Pago', 'Número Ventas', 'Total Ventas'])
-                    fig = px.pie(df, values='Total Ventas', names='Método Pago', title='Distribución por Método de Pago')
+                datos = obtener_parciales_diarios("ventas_metodo_pago", fecha_inicio_ventas, fecha_fin_ventas)
+
+                if datos is not None and not datos.empty:
+                    df = (datos.groupby("metodo_pago")[["numero_ventas", "total_ventas"]].sum()
+                          .sort_values("total_ventas", ascending=False).reset_index())
+                    df.columns = ['Método Pago', 'Número Ventas', 'Total Ventas']
+                    with tramo("chart"):
+                        fig = px.pie(df, values='Total Ventas', names='Método Pago', title='Distribución por Método de Pago')
                     st.plotly_chart(fig, use_container_width=True)
 
+        # Exportación completa por línea de venta, pensada para rangos grandes
+        if reporte_tipo == "Ventas por Período":
+            nombre_detalle = f"detalle_ventas_{fecha_inicio_ventas}_{fecha_fin_ventas}.csv.gz"
+            params_detalle = (fecha_inicio_ventas, fecha_fin_ventas)
+            url_descargas = obtener_servidor_descargas()
+
+            if url_descargas:
+                if st.button("📦 Exportar Detalle por Línea (CSV.gz)", use_container_width=True):
+                    url = publicar_exportacion(url_descargas, nombre_detalle, CONSULTA_DETALLE_VENTAS, params_detalle)
+                    if url:
+                        st.link_button("📥 Descargar Detalle", url, use_container_width=True)
+            elif (fecha_fin_ventas - fecha_inicio_ventas).days + 1 > EXPORTACION_MAX_DIAS:
+                st.caption(f"El detalle por línea se puede descargar hasta {EXPORTACION_MAX_DIAS} días por archivo. "
+                           "Para rangos mayores configura DESCARGAS_PUERTO y DESCARGAS_URL.")
+            else:
+                # La exportación corre recién al pulsar el botón, y sin rerun de la página
+                st.download_button(
+                    "📦 Descargar Detalle por Línea (CSV.gz)",
+                    lambda: exportacion_en_memoria(CONSULTA_DETALLE_VENTAS, params_detalle),
+                    nombre_detalle,
+                    "application/gzip",
+                    on_click="ignore",
+                    use_container_width=True
+                )
+
+        # Invalidación manual tras correcciones de ventas en meses ya cerrados
+        with st.expander("🗄️ Caché de meses cerrados"):
+            st.caption("Los reportes de meses cerrados se sirven desde caché. "
+                       "Si se corrigen ventas de un mes pasado, invalida ese mes para recalcularlo.")
+            col1, col2 = st.columns(2)
+            with col1:
+                invalidar_desde = st.date_input("Desde (mes)", value=pd.to_datetime("today") - pd.DateOffset(months=1),
+                                                key="invalidar_desde")
+            with col2:
+                invalidar_hasta = st.date_input("Hasta (mes)", value=pd.to_datetime("today"), key="invalidar_hasta")
+            if st.button("🧹 Invalidar Caché", use_container_width=True):
+                eliminados = invalidar_cache_reportes(invalidar_desde, invalidar_hasta)
+                st.success(f"✅ {eliminados} archivos de caché eliminados")
+
     with tab3:
         st.subheader("📦 Reportes de Inventario")
 
@@ -833,13 +2109,62 @@ def modulo_reportes():
         if st.session_state.user['rol'] == 'admin':
             query_personalizada = st.text_area("Escribe tu consulta SQL:", height=100,
                                               placeholder="SELECT * FROM ventas WHERE fecha_venta >= CURRENT_DATE - INTERVAL '7 days'")
+            st.caption(f"Solo lectura · límite {SQL_TIMEOUT_MS / 1000:,.0f} s · máximo {SQL_MAX_FILAS:,} filas")
+
+            col1, col2 = st.columns(2)
+            with col1:
+                modo = st.radio("Modo", MODOS_CONSULTA, horizontal=True)
+            with col2:
+                forzar = st.checkbox(f"Permitir costo estimado mayor a {SQL_COSTO_MAX:,.0f}")
 
             if st.button("▶️ Ejecutar Consulta", use_container_width=True):
                 if query_personalizada:
+                    consulta = sentencia_unica(query_personalizada)
+                    conexion = None
+                    resultado, columnas, explain = None, None, None
                     try:
-                        resultado = ejecutar_consulta(query_personalizada)
+                        if consulta is None:
+                            raise ValueError("escribe una sola sentencia SQL; no se ejecutó nada")
+                        with tramo("db"):
+                            conexion = conexion_solo_lectura()
+                            cur = conexion.cursor()
+
+                            # Costo estimado antes de ejecutar nada
+                            cur.execute(f"EXPLAIN (FORMAT JSON) {consulta}")
+                            costo = cur.fetchone()[0][0]["Plan"]["Total Cost"]
+
+                            if costo > SQL_COSTO_MAX and not forzar:
+                                st.warning(f"⚠️ Costo estimado {costo:,.0f} supera el máximo de {SQL_COSTO_MAX:,.0f}. "
+                                           "Revisa el plan o marca la casilla para ejecutarla de todas formas.")
+                            elif modo == MODOS_CONSULTA[0]:
+                                # Cursor de servidor: solo viajan las filas que se muestran
+                                cur_servidor = conexion.cursor(name="consulta_personalizada")
+                                cur_servidor.execute(consulta)
+                                resultado = cur_servidor.fetchmany(SQL_MAX_FILAS + 1)
+                                columnas = [c[0] for c in cur_servidor.description]
+                            else:
+                                cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {consulta}")
+                                explain = cur.fetchone()[0][0]
+                    except psycopg2.errors.QueryCanceled:
+                        st.error(f"⏱️ La consulta superó el límite de {SQL_TIMEOUT_MS / 1000:,.0f} s y fue cancelada")
+                    except psycopg2.errors.LockNotAvailable:
+                        st.error("🔒 La consulta esperaba un bloqueo y fue cancelada")
+                    except Exception as e:
+                        st.error(f"Error en la consulta: {e}")
+                    finally:
+                        # Nunca se confirma nada: la transacción siempre se descarta
+                        if conexion is not None:
+                            conexion.rollback()
+                            conexion.close()
+
+                    if explain:
+                        mostrar_plan(explain)
+                    elif columnas is not None:
                         if resultado:
-                            df_resultado = pd.DataFrame(resultado)
+                            if len(resultado) > SQL_MAX_FILAS:
+                                resultado = resultado[:SQL_MAX_FILAS]
+                                st.warning(f"Se muestran solo las primeras {SQL_MAX_FILAS:,} filas")
+                            df_resultado = pd.DataFrame(resultado, columns=columnas)
                             st.dataframe(df_resultado, use_container_width=True)
 
                             # Opciones de exportación
@@ -854,19 +2179,22 @@ def modulo_reportes():
                                     use_container_width=True
                                 )
                             with col2:
+                                # to_excel necesita openpyxl; sin él queda solo el CSV
                                 excel_buffer = io.BytesIO()
-                                df_resultado.to_excel(excel_buffer, index=False)
-                                st.download_button(
-                                    "📊 Descargar Excel",
-                                    excel_buffer.getvalue(),
-                                    "reporte_personalizado.xlsx",
-                                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                    use_container_width=True
-                                )
+                                try:
+                                    df_resultado.to_excel(excel_buffer, index=False)
+                                except ImportError:
+                                    st.caption("Instala openpyxl para descargar en Excel")
+                                else:
+                                    st.download_button(
+                                        "📊 Descargar Excel",
+                                        excel_buffer.getvalue(),
+                                        "reporte_personalizado.xlsx",
+                                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                        use_container_width=True
+                                    )
                         else:
                             st.info("La consulta no devolvió resultados")
-                    except Exception as e:
-                        st.error(f"Error en la consulta: {e}")
                 else:
                     st.warning("Por favor, escribe una consulta SQL")
         else:
@@ -911,6 +2239,17 @@ def main():
 
         rol = st.session_state.user['rol']
 
+        # Triggers auxiliares que aún no se instalaron (solo administradores)
+        faltantes = [t for t in TRIGGERS if t not in triggers_instalados()] if rol == "admin" else []
+        if faltantes:
+            with st.sidebar.expander(f"⚠️ {len(faltantes)} objetos de BD no disponibles"):
+                st.caption("Ejecuta `python migrar_bd.py` para crearlos; mientras tanto se consultan las tablas base")
+                for tabla, nombre in faltantes:
+                    st.caption(f"{nombre} en {tabla}")
+
+        if rol == "admin":
+            st.sidebar.checkbox("🧪 Perfilar página (cProfile)", key="perfilar_pagina")
+
         # Menú dinámico según rol
         if rol == "admin":
             menu = st.sidebar.selectbox(
@@ -0,0 +1,121 @@
+# Benchmark de cobro concurrente: simula varios cajeros vendiendo los mismos
+# productos a la vez y mide ventas por segundo con el motor y el pool de cobro
+# que usa app_ferreteria (con más cajeros que conexiones, las ventas esperan turno).
+#
+# ⚠️ Ejecutar solo contra una base de pruebas: registra ventas reales y repone
+# el stock de los productos usados.
+#
+# Uso:
+#   python benchmark_ventas.py --dsn "host=localhost dbname=ferreteria user=postgres" \
+#       --cajeros 1,2,4,8,16,32 --pool 8 --duracion 10 --productos 10
+import argparse
+import random
+import statistics
+import threading
+import time
+
+import psycopg2
+
+from motor_ventas import PoolVentas, StockInsuficiente, registrar_venta_concurrente
+
+STOCK_BENCHMARK = 1_000_000_000
+
+def preparar_productos(dsn, cantidad):
+    conexion = psycopg2.connect(dsn)
+    cur = conexion.cursor()
+    cur.execute("""
+        SELECT id, nombre, precio_venta
+        FROM productos
+        WHERE activo = true
+        ORDER BY id
+        LIMIT %s
+    """, (cantidad,))
+    productos = cur.fetchall()
+
+    # Stock alto para que el benchmark mida contención y no quiebres de stock
+    cur.execute("UPDATE productos SET stock_actual = %s WHERE id = ANY(%s)",
+                (STOCK_BENCHMARK, [p[0] for p in productos]))
+    cur.execute("SELECT id FROM clientes ORDER BY id LIMIT 1000")
+    clientes = [c[0] for c in cur.fetchall()]
+    conexion.commit()
+    conexion.close()
+    return productos, clientes
+
+def cajero(pool, productos, clientes, items, fin, resultados, lock):
+    ventas, reintentos, errores, latencias = 0, 0, 0, []
+
+    while time.perf_counter() < fin:
+        carrito = [
+            {"producto_id": p[0], "nombre": p[1], "precio": float(p[2]), "cantidad": random.randint(1, 3)}
+            for p in random.sample(productos, min(items, len(productos)))
+        ]
+        inicio = time.perf_counter()
+        try:
+            with pool.conexion() as conexion:
+                _, intentos = registrar_venta_concurrente(
+                    conexion, carrito, random.choice(clientes) if clientes else None, 1, "Efectivo"
+                )
+            ventas += 1
+            reintentos += intentos
+            latencias.append(time.perf_counter() - inicio)
+        except StockInsuficiente:
+            errores += 1
+        except psycopg2.Error:
+            errores += 1
+
+    with lock:
+        resultados["ventas"] += ventas
+        resultados["reintentos"] += reintentos
+        resultados["errores"] += errores
+        resultados["latencias"].extend(latencias)
+
+def ejecutar_nivel(pool, productos, clientes, cajeros, items, duracion):
+    resultados = {"ventas": 0, "reintentos": 0, "errores": 0, "latencias": []}
+    lock = threading.Lock()
+    inicio = time.perf_counter()
+    fin = inicio + duracion
+
+    hilos = [
+        threading.Thread(target=cajero, args=(pool, productos, clientes, items, fin, resultados, lock))
+        for _ in range(cajeros)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    transcurrido = time.perf_counter() - inicio
+    latencias = sorted(resultados["latencias"]) or [0.0]
+    percentiles = statistics.quantiles(latencias, n=100) if len(latencias) > 1 else latencias * 99
+    return {
+        "cajeros": cajeros,
+        "ventas_s": resultados["ventas"] / transcurrido,
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "reintentos": resultados["reintentos"],
+        "errores": resultados["errores"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de cobro concurrente")
+    parser.add_argument("--dsn", default="", help="Cadena de conexión libpq (por defecto, variables PG*)")
+    parser.add_argument("--cajeros", default="1,2,4,8,16,32", help="Niveles de concurrencia separados por coma")
+    parser.add_argument("--duracion", type=float, default=10, help="Segundos por nivel")
+    parser.add_argument("--pool", type=int, default=8, help="Conexiones de cobro (DB_POOL_VENTAS en la app)")
+    parser.add_argument("--productos", type=int, default=10, help="Productos compartidos por todos los cajeros")
+    parser.add_argument("--items", type=int, default=3, help="Productos distintos por venta")
+    args = parser.parse_args()
+
+    productos, clientes = preparar_productos(args.dsn, args.productos)
+    if not productos:
+        raise SystemExit("No hay productos activos para el benchmark")
+
+    pool = PoolVentas(args.pool, dsn=args.dsn)
+    print(f"{'Cajeros':>8} {'Ventas/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'Reintentos':>11} {'Errores':>8}")
+    for cajeros in [int(n) for n in args.cajeros.split(",")]:
+        r = ejecutar_nivel(pool, productos, clientes, cajeros, args.items, args.duracion)
+        print(f"{r['cajeros']:>8} {r['ventas_s']:>10.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} "
+              f"{r['reintentos']:>11} {r['errores']:>8}")
+
+if __name__ == "__main__":
+    main()
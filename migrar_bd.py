@@ -0,0 +1,253 @@
+# Migración de los objetos auxiliares de base de datos que usa app_ferreteria
+# (índices, resúmenes y triggers). La app no crea nada al arrancar: comprueba qué
+# triggers existen y, mientras falte alguno, consulta las tablas base en su lugar.
+#
+# Los índices se crean con CREATE INDEX CONCURRENTLY, sin frenar las ventas.
+# La carga inicial de resumen_cliente_mensual bloquea las escrituras en ventas
+# mientras agrega la tabla completa (para no perder ni duplicar ventas): ejecutar
+# la primera vez fuera del horario de atención. Las siguientes ejecuciones solo
+# crean lo que falte, así que es seguro repetirla tras un error.
+#
+# Uso:
+#   python migrar_bd.py --dsn "host=localhost dbname=ferreteria user=postgres"
+import argparse
+import sys
+import time
+
+import psycopg2
+
+# Los triggers se crean solo si faltan: un DROP/CREATE pide un bloqueo exclusivo
+# de la tabla. El LOCK y la segunda comprobación evitan crearlo dos veces si se
+# ejecutan dos migraciones a la vez.
+def trigger_si_falta(nombre, tabla, definicion, carga_inicial=""):
+    existe = f"EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{nombre}' AND tgrelid = '{tabla}'::regclass)"
+    return f"""
+    DO $$
+    BEGIN
+        IF NOT {existe} THEN
+            LOCK TABLE {tabla} IN SHARE ROW EXCLUSIVE MODE;
+            IF NOT {existe} THEN
+                {definicion};
+                {carga_inicial}
+            END IF;
+        END IF;
+    END $$
+    """
+
+EXTENSION = ("extensión pg_trgm", "CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+INDICES = [
+    # Búsqueda de clientes: prefijo de cédula y subcadena de nombre
+    ("idx_clientes_nombre_trgm", "ON clientes USING gin (nombre gin_trgm_ops)"),
+    ("idx_clientes_cedula_patron", "ON clientes (cedula text_pattern_ops)"),
+    # Historial de compras: paginación por (cliente, fecha, id)
+    ("idx_ventas_cliente_fecha", "ON ventas (cliente_id, fecha_venta, id)"),
+    ("idx_ventas_fecha", "ON ventas (fecha_venta)"),
+    ("idx_venta_detalles_venta", "ON venta_detalles (venta_id)"),
+]
+
+# (tabla, trigger) que la app comprueba antes de usar los objetos que mantienen
+TRIGGERS = [
+    ("ventas", "trg_resumen_cliente_mensual"),
+    ("productos", "trg_notificar_stock_bajo"),
+]
+
+OBJETOS_BD = [
+    # Serie mensual precalculada por cliente
+    ("tabla resumen_cliente_mensual", """
+    CREATE TABLE IF NOT EXISTS resumen_cliente_mensual (
+        cliente_id INTEGER NOT NULL,
+        mes DATE NOT NULL,
+        num_compras INTEGER NOT NULL DEFAULT 0,
+        total_mes NUMERIC(14, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (cliente_id, mes)
+    )
+    """),
+    ("función fn_resumen_cliente_mensual", """
+    CREATE OR REPLACE FUNCTION fn_resumen_cliente_mensual() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.cliente_id IS NOT NULL THEN
+            UPDATE resumen_cliente_mensual
+               SET num_compras = num_compras - 1,
+                   total_mes = total_mes - COALESCE(OLD.total, 0)
+             WHERE cliente_id = OLD.cliente_id
+               AND mes = date_trunc('month', OLD.fecha_venta)::date;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.cliente_id IS NOT NULL THEN
+            INSERT INTO resumen_cliente_mensual (cliente_id, mes, num_compras, total_mes)
+            VALUES (NEW.cliente_id, date_trunc('month', NEW.fecha_venta)::date, 1, COALESCE(NEW.total, 0))
+            ON CONFLICT (cliente_id, mes) DO UPDATE
+               SET num_compras = resumen_cliente_mensual.num_compras + 1,
+                   total_mes = resumen_cliente_mensual.total_mes + EXCLUDED.total_mes;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """),
+    # Trigger y carga inicial en la misma transacción para no perder ventas.
+    # Es diferido: la fila del resumen se bloquea solo al confirmar la venta,
+    # así las ventas simultáneas del mismo cliente no se esperan entre sí
+    ("trigger trg_resumen_cliente_mensual", trigger_si_falta("trg_resumen_cliente_mensual", "ventas", """
+                CREATE CONSTRAINT TRIGGER trg_resumen_cliente_mensual
+                    AFTER INSERT OR DELETE OR UPDATE OF cliente_id, fecha_venta, total ON ventas
+                    DEFERRABLE INITIALLY DEFERRED
+                    FOR EACH ROW EXECUTE FUNCTION fn_resumen_cliente_mensual()""", """
+                DELETE FROM resumen_cliente_mensual;
+                INSERT INTO resumen_cliente_mensual (cliente_id, mes, num_compras, total_mes)
+                SELECT cliente_id, date_trunc('month', fecha_venta)::date, COUNT(*), COALESCE(SUM(total), 0)
+                FROM ventas
+                WHERE cliente_id IS NOT NULL
+                GROUP BY cliente_id, date_trunc('month', fecha_venta)::date;""")),
+    # Aviso de stock bajo: notifica solo los productos que están o estaban bajo el mínimo
+    ("función fn_notificar_stock_bajo", """
+    CREATE OR REPLACE FUNCTION fn_notificar_stock_bajo() RETURNS trigger AS $$
+    DECLARE
+        bajo_antes BOOLEAN := false;
+        bajo_ahora BOOLEAN := false;
+        fila RECORD;
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            bajo_antes := COALESCE(OLD.activo AND OLD.stock_actual <= OLD.stock_minimo, false);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            bajo_ahora := COALESCE(NEW.activo AND NEW.stock_actual <= NEW.stock_minimo, false);
+            fila := NEW;
+        ELSE
+            fila := OLD;
+        END IF;
+        IF bajo_antes OR bajo_ahora THEN
+            PERFORM pg_notify('stock_bajo', json_build_object(
+                'id', fila.id,
+                'nombre', fila.nombre,
+                'stock_actual', fila.stock_actual,
+                'stock_minimo', fila.stock_minimo,
+                'bajo', bajo_ahora
+            )::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """),
+    ("trigger trg_notificar_stock_bajo", trigger_si_falta("trg_notificar_stock_bajo", "productos", """
+                CREATE TRIGGER trg_notificar_stock_bajo
+                    AFTER INSERT OR DELETE OR UPDATE OF nombre, stock_actual, stock_minimo, activo ON productos
+                    FOR EACH ROW EXECUTE FUNCTION fn_notificar_stock_bajo()""")),
+]
+
+# Versiones para la caché compartida: cada clave tiene un trigger diferido que
+# suma uno a su contador en cache_versiones al confirmar la transacción que
+# modificó la tabla. Al ser filas (y no una secuencia), la nueva versión solo es
+# visible cuando el cambio ya está confirmado.
+# - En productos, el catálogo ("productos") y las existencias ("stock") tienen
+#   versiones separadas: una venta solo cambia el stock y no invalida lo que
+#   depende del catálogo.
+# - Cada transacción suma una sola vez por clave, aunque modifique muchas filas.
+# - El contador se reparte en particiones por proceso del servidor: los cobros
+#   simultáneos no esperan todos a la misma fila. La app usa como versión un hash
+#   de todas las particiones.
+PARTICIONES_VERSION = 16
+
+# (clave, tabla, trigger, columnas cuyo UPDATE cambia la versión; None = todas)
+VERSIONES_CACHE = [
+    ("productos", "productos", "trg_cache_version",
+     "codigo, nombre, descripcion, categoria_id, marca, precio_compra, precio_venta, activo"),
+    ("stock", "productos", "trg_cache_version_stock", "stock_actual, stock_minimo"),
+    ("categorias", "categorias", "trg_cache_version", None),
+    ("clientes", "clientes", "trg_cache_version", None),
+    ("ventas", "ventas", "trg_cache_version", None),
+]
+
+OBJETOS_BD += [
+    ("tabla cache_versiones", """
+    CREATE TABLE IF NOT EXISTS cache_versiones (
+        clave TEXT NOT NULL,
+        particion INTEGER NOT NULL,
+        version BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (clave, particion)
+    )
+    """),
+    ("función fn_cache_version", f"""
+    CREATE OR REPLACE FUNCTION fn_cache_version() RETURNS trigger AS $$
+    DECLARE
+        marca TEXT := 'ferreteria.cache_version_' || TG_ARGV[0];
+    BEGIN
+        IF current_setting(marca, true) = txid_current()::text THEN
+            RETURN NULL;
+        END IF;
+        PERFORM set_config(marca, txid_current()::text, true);
+        INSERT INTO cache_versiones (clave, particion, version)
+        VALUES (TG_ARGV[0], pg_backend_pid() % {PARTICIONES_VERSION}, 1)
+        ON CONFLICT (clave, particion) DO UPDATE SET version = cache_versiones.version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """),
+]
+OBJETOS_BD += [
+    (f"trigger {trigger} en {tabla}", trigger_si_falta(trigger, tabla, f"""
+                CREATE CONSTRAINT TRIGGER {trigger}
+                    AFTER INSERT OR DELETE OR UPDATE{f" OF {columnas}" if columnas else ""} ON {tabla}
+                    DEFERRABLE INITIALLY DEFERRED
+                    FOR EACH ROW EXECUTE FUNCTION fn_cache_version('{clave}')"""))
+    for clave, tabla, trigger, columnas in VERSIONES_CACHE
+]
+TRIGGERS += [(tabla, trigger) for _, tabla, trigger, _ in VERSIONES_CACHE]
+
+# Un CREATE INDEX CONCURRENTLY interrumpido deja el índice marcado como inválido:
+# se borra y se vuelve a crear
+def crear_indice(cur, nombre, definicion):
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (nombre,))
+    fila = cur.fetchone()
+    if fila and not fila[0]:
+        cur.execute(f"DROP INDEX CONCURRENTLY {nombre}")
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nombre} {definicion}")
+
+def migrar(dsn, lock_timeout_ms):
+    # Autocommit: CREATE INDEX CONCURRENTLY no puede ir dentro de una transacción
+    # y cada paso se confirma por separado
+    conexion = psycopg2.connect(dsn)
+    conexion.autocommit = True
+    cur = conexion.cursor()
+    errores = 0
+
+    def paso(descripcion, accion):
+        nonlocal errores
+        inicio = time.perf_counter()
+        try:
+            accion()
+            print(f"  ✓ {descripcion} ({time.perf_counter() - inicio:.1f} s)")
+        except psycopg2.Error as e:
+            errores += 1
+            print(f"  ✗ {descripcion}: {str(e).strip()}")
+
+    # Sin lock_timeout: la creación concurrente espera a las transacciones en curso
+    # sin bloquear las escrituras
+    print("Índices")
+    paso(EXTENSION[0], lambda: cur.execute(EXTENSION[1]))
+    for nombre, definicion in INDICES:
+        paso(f"índice {nombre}", lambda: crear_indice(cur, nombre, definicion))
+
+    # Si un objeto necesita un bloqueo ocupado se reporta el error en lugar de esperar
+    # (y de dejar en cola, detrás de la espera, a las ventas que llegan)
+    print("Resúmenes y triggers")
+    cur.execute(f"SET lock_timeout = {int(lock_timeout_ms)}")
+    for descripcion, sentencia in OBJETOS_BD:
+        paso(descripcion, lambda: cur.execute(sentencia))
+
+    conexion.close()
+    return errores
+
+def main():
+    parser = argparse.ArgumentParser(description="Crea los índices, resúmenes y triggers que usa app_ferreteria")
+    parser.add_argument("--dsn", default="", help="Cadena de conexión de psycopg2 (por defecto, variables PG*)")
+    parser.add_argument("--lock-timeout", type=int, default=2000,
+                        help="Espera máxima por un bloqueo de tabla, en ms (0 = sin límite)")
+    args = parser.parse_args()
+
+    errores = migrar(args.dsn, args.lock_timeout)
+    if errores:
+        print(f"{errores} pasos con error; revisa los mensajes y vuelve a ejecutar la migración (solo crea lo que falte)")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Motor de cobro concurrente, sin dependencias de Streamlit: lo usan
+# app_ferreteria.py y benchmark_ventas.py (importarlo no ejecuta la app).
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.pool
+
+MAX_REINTENTOS_VENTA = 5
+ESPERA_POOL_SEGUNDOS = 30
+
+# Pool de conexiones para el cobro: si todas están ocupadas, la venta espera
+# turno en lugar de fallar con "connection pool exhausted"
+class PoolVentas:
+    def __init__(self, maximo, **parametros):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, maximo, **parametros)
+        self.libres = threading.BoundedSemaphore(maximo)
+
+    @contextmanager
+    def conexion(self, espera=ESPERA_POOL_SEGUNDOS):
+        if not self.libres.acquire(timeout=espera):
+            raise psycopg2.pool.PoolError(
+                f"Todas las conexiones de cobro siguen ocupadas tras {espera} s; intenta de nuevo"
+            )
+        try:
+            conexion = self.pool.getconn()
+            try:
+                yield conexion
+            finally:
+                self.pool.putconn(conexion, close=bool(conexion.closed))
+        finally:
+            self.libres.release()
+
+class StockInsuficiente(Exception):
+    def __init__(self, faltantes):
+        self.faltantes = faltantes
+        detalle = ", ".join(f"{nombre} (stock {stock}, pedido {pedido})" for _, nombre, stock, pedido in faltantes)
+        super().__init__(f"Stock insuficiente: {detalle}")
+
+# Bloquea los productos en orden de id (sin interbloqueos), valida el stock de
+# todo el carrito en una sola sentencia y reintenta los conflictos
+def registrar_venta_concurrente(conexion, carrito, cliente_id, usuario_id, metodo_pago,
+                                max_reintentos=MAX_REINTENTOS_VENTA):
+    cantidades = {}
+    for item in carrito:
+        cantidades[item["producto_id"]] = cantidades.get(item["producto_id"], 0) + item["cantidad"]
+    ids = sorted(cantidades)
+    pedidas = [cantidades[i] for i in ids]
+    detalles_json = json.dumps(carrito)
+
+    for intento in range(max_reintentos + 1):
+        cur = conexion.cursor()
+        try:
+            # Bloqueo ordenado y verificación de stock de todo el carrito
+            cur.execute("""
+                SELECT p.id, p.nombre, p.stock_actual, c.cantidad
+                FROM productos p
+                JOIN unnest(%s::int[], %s::int[]) AS c(producto_id, cantidad) ON c.producto_id = p.id
+                WHERE p.activo = true
+                ORDER BY p.id
+                FOR UPDATE OF p
+            """, (ids, pedidas))
+            bloqueados = cur.fetchall()
+            faltantes = [fila for fila in bloqueados if fila[2] < fila[3]]
+            encontrados = {fila[0] for fila in bloqueados}
+            faltantes += [(i, f"ID {i}", 0, cantidades[i]) for i in ids if i not in encontrados]
+            if faltantes:
+                conexion.rollback()
+                raise StockInsuficiente(faltantes)
+
+            cur.callproc("sp_registrar_venta", (detalles_json, cliente_id, usuario_id, metodo_pago))
+            resultado = cur.fetchone()
+            conexion.commit()
+            return resultado, intento
+        except (psycopg2.errors.SerializationFailure, psycopg2.errors.DeadlockDetected):
+            conexion.rollback()
+            if intento == max_reintentos:
+                raise
+            # Espera exponencial con variación aleatoria para no reintentar todos a la vez
+            time.sleep(min(0.02 * 2 ** intento, 1.0) * random.uniform(0.5, 1.5))
+        except Exception:
+            conexion.rollback()
+            raise
+        finally:
+            cur.close()
@@ -0,0 +1,372 @@
+# Prueba de carga multiusuario: ejecuta app_ferreteria.py sin navegador con la API
+# de pruebas de Streamlit (AppTest), simulando sesiones admin/vendedor/inventarista
+# concurrentes contra un PostgreSQL local, y reporta latencia de rerun,
+# consultas por rerun y memoria por sesión.
+#
+# ⚠️ Usar una base de pruebas: --sembrar inserta datos sintéticos y los vendedores
+# simulados registran ventas.
+#
+# Uso:
+#   python prueba_carga.py --host localhost --db ferreteria_carga --user postgres --sembrar
+#   python prueba_carga.py --host localhost --db ferreteria_carga --niveles 1,4,8,16 --duracion 30
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+import psycopg2.extensions
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.testing.v1 import AppTest
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_ferreteria.py")
+PASSWORD_CARGA = "carga123"
+USUARIOS_CARGA = {
+    "admin": "carga_admin",
+    "vendedor": "carga_vendedor",
+    "inventarista": "carga_inventarista",
+}
+CLAVE_CONSULTAS = "_prueba_carga_consultas"
+MAX_FALLOS_SEGUIDOS = 3
+
+# preparar_sesiones_concurrentes reemplaza internals privados de Streamlit
+# (Runtime.instance/exists, ScriptCache.get_bytecode, Secrets._secrets) que
+# cambian entre versiones; el arnés se verificó con estas
+VERSIONES_STREAMLIT_PROBADAS = ("1.66.",)
+
+# Conteo de consultas por sesión: cada cursor suma en el session_state del rerun actual
+class CursorContador(psycopg2.extensions.cursor):
+    def _contar(self):
+        if get_script_run_ctx() is not None:
+            st.session_state[CLAVE_CONSULTAS] = st.session_state.get(CLAVE_CONSULTAS, 0) + 1
+
+    def execute(self, query, vars=None):
+        self._contar()
+        return super().execute(query, vars)
+
+    def callproc(self, procname, parameters=None):
+        self._contar()
+        return super().callproc(procname, parameters)
+
+def instalar_contador_consultas():
+    conectar_original = psycopg2.connect
+
+    def conectar(*args, **kwargs):
+        kwargs.setdefault("cursor_factory", CursorContador)
+        return conectar_original(*args, **kwargs)
+
+    psycopg2.connect = conectar
+
+# AppTest está pensado para una sesión a la vez: en cada rerun reemplaza y luego borra
+# el Runtime global, st.secrets y la opción global.appTest, y vuelve a compilar el script
+# (ast.parse no es seguro entre hilos). Para simular sesiones concurrentes dentro de un
+# mismo proceso, como en un worker real, esos globales se fijan una sola vez.
+def verificar_version_streamlit():
+    if not st.__version__.startswith(VERSIONES_STREAMLIT_PROBADAS):
+        raise SystemExit(
+            f"prueba_carga.py se verificó con Streamlit {', '.join(v + 'x' for v in VERSIONES_STREAMLIT_PROBADAS)} "
+            f"y está instalado {st.__version__}: revisa preparar_sesiones_concurrentes (usa internals "
+            "privados) y agrega la versión a VERSIONES_STREAMLIT_PROBADAS, o usa --ignorar-version"
+        )
+
+def preparar_sesiones_concurrentes(args):
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner import script_cache
+    from streamlit.runtime.secrets import Secrets
+
+    secretos = Secrets()
+    secretos._secrets = {
+        "DB_HOST": args.host,
+        "DB_NAME": args.db,
+        "DB_USER": args.user,
+        "DB_PASSWORD": args.password,
+        "DB_PORT": str(args.port),
+    }
+    st.secrets = secretos
+    config.set_option("global.appTest", True)
+
+    # Si otra sesión terminó y dejó el Runtime en None, se usa el último creado
+    ultimo = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            ultimo["runtime"] = cls._instance
+            return cls._instance
+        if "runtime" in ultimo:
+            return ultimo["runtime"]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    def exists(cls):
+        return cls._instance is not None or "runtime" in ultimo
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(exists)
+
+    # Un servidor Streamlit compila el script una vez por proceso
+    cache = script_cache.ScriptCache()
+    lock = threading.Lock()
+    get_bytecode_original = script_cache.ScriptCache.get_bytecode
+
+    def get_bytecode(self, script_path):
+        with lock:
+            return get_bytecode_original(cache, script_path)
+
+    script_cache.ScriptCache.get_bytecode = get_bytecode
+
+# Datos sintéticos
+def sembrar(args):
+    conexion = psycopg2.connect(host=args.host, dbname=args.db, user=args.user,
+                                password=args.password, port=args.port)
+    cur = conexion.cursor()
+
+    cur.execute("SELECT 1 FROM usuarios WHERE username = %s", (USUARIOS_CARGA["admin"],))
+    if cur.fetchone():
+        print("La base ya tiene datos de carga; no se vuelve a sembrar")
+        conexion.close()
+        return
+
+    for rol, username in USUARIOS_CARGA.items():
+        cur.execute("""
+            INSERT INTO usuarios (username, password, nombre, rol, activo)
+            VALUES (%s, %s, %s, %s, true)
+        """, (username, PASSWORD_CARGA, f"Carga {rol}", rol))
+
+    cur.execute("""
+        INSERT INTO categorias (nombre)
+        SELECT 'Categoría ' || g FROM generate_series(1, 10) g
+    """)
+    cur.execute("""
+        INSERT INTO productos (nombre, descripcion, categoria_id, marca, precio_compra,
+                               precio_venta, stock_actual, stock_minimo)
+        SELECT 'Producto sintético ' || g, 'Generado para prueba de carga',
+               cats[1 + g %% array_length(cats, 1)], 'Marca ' || (g %% 50),
+               round((1 + random() * 50)::numeric, 2), round((2 + random() * 80)::numeric, 2),
+               (random() * 500)::int, 5 + (random() * 20)::int
+        FROM generate_series(1, %s) g,
+             (SELECT array_agg(id) AS cats FROM categorias) c
+    """, (args.productos,))
+    cur.execute("""
+        INSERT INTO clientes (cedula, nombre, telefono, email, direccion)
+        SELECT 'S' || lpad(g::text, 12, '0'), 'Cliente Sintético ' || g, '0999' || lpad(g::text, 6, '0'),
+               'cliente' || g || '@carga.test', 'Calle ' || g
+        FROM generate_series(1, %s) g
+    """, (args.clientes,))
+    cur.execute("""
+        INSERT INTO ventas (numero_factura, cliente_id, fecha_venta, total, metodo_pago)
+        SELECT 'CARGA-' || g, cli[1 + (random() * (array_length(cli, 1) - 1))::int],
+               now() - random() * interval '730 days', 0,
+               (ARRAY['Efectivo', 'Tarjeta', 'Transferencia'])[1 + (random() * 2)::int]
+        FROM generate_series(1, %s) g,
+             (SELECT array_agg(id) AS cli FROM clientes WHERE cedula LIKE 'S%%') c
+    """, (args.ventas,))
+    cur.execute("""
+        INSERT INTO venta_detalles (venta_id, producto_id, cantidad, precio)
+        SELECT v.id, prods[1 + ((v.id * k * 7919) % array_length(prods, 1))], 1 + (v.id + k) % 5,
+               round((2 + random() * 80)::numeric, 2)
+        FROM ventas v
+        CROSS JOIN LATERAL generate_series(1, 1 + v.id % 4) k,
+             (SELECT array_agg(id) AS prods FROM productos WHERE nombre LIKE 'Producto sintético %') p
+        WHERE v.numero_factura LIKE 'CARGA-%'
+    """)
+    cur.execute("""
+        UPDATE ventas v SET total = d.total
+        FROM (SELECT venta_id, SUM(cantidad * precio) AS total FROM venta_detalles GROUP BY venta_id) d
+        WHERE d.venta_id = v.id AND v.numero_factura LIKE 'CARGA-%'
+    """)
+    conexion.commit()
+    conexion.close()
+    print(f"Sembrados {args.productos} productos, {args.clientes} clientes y {args.ventas} ventas")
+
+# Sesiones simuladas
+def boton(at, etiqueta):
+    return next(b for b in at.button if b.label == etiqueta)
+
+def navegar(at, menu):
+    at.sidebar.selectbox[0].set_value(menu)
+
+def paso_dashboard(at, _):
+    navegar(at, "Dashboard")
+
+def paso_reportes(at, _):
+    navegar(at, "Reportes")
+    at.run()
+    boton(at, "🔄 Generar Reporte").click()
+
+def paso_productos(at, _):
+    navegar(at, "Productos")
+
+def paso_ventas(at, iteracion):
+    navegar(at, "Ventas")
+    at.run()
+    if not any(b.label == "➕ Agregar al Carrito" for b in at.button):
+        return
+    productos = at.selectbox[0]
+    productos.set_value(random.choice(productos.options))
+    boton(at, "➕ Agregar al Carrito").click()
+    if iteracion % 5 == 4 and any(b.label == "💳 Procesar Venta" for b in at.button):
+        at.run()
+        boton(at, "💳 Procesar Venta").click()
+
+def paso_clientes(at, _):
+    navegar(at, "Clientes")
+
+ESCENARIOS = {
+    "admin": [("dashboard", paso_dashboard), ("modulo_reportes", paso_reportes), ("modulo_ventas", paso_ventas)],
+    "vendedor": [("modulo_ventas", paso_ventas), ("modulo_clientes", paso_clientes)],
+    "inventarista": [("modulo_productos", paso_productos)],
+}
+
+def crear_sesion(args):
+    return AppTest.from_file(RUTA_APP, default_timeout=args.timeout)
+
+def ejecutar_medido(at, pagina, registro):
+    at.session_state[CLAVE_CONSULTAS] = 0
+    inicio = time.perf_counter()
+    at.run()
+    errores = len(at.exception)
+    registro.append((pagina, time.perf_counter() - inicio, at.session_state[CLAVE_CONSULTAS], errores))
+    return errores
+
+def iniciar_sesion(args, rol, registro):
+    at = crear_sesion(args)
+    at.run()
+    at.sidebar.text_input[0].set_value(USUARIOS_CARGA[rol])
+    at.sidebar.text_input[1].set_value(PASSWORD_CARGA)
+    boton(at, "🚀 Ingresar").click()
+    ejecutar_medido(at, "login", registro)
+    return at
+
+def usuario_virtual(args, rol, fin, registro, sesiones):
+    try:
+        at = iniciar_sesion(args, rol, registro)
+    except (StopIteration, IndexError):
+        registro.append(("login", 0.0, 0, 1))
+        return
+    sesiones.append(at)
+
+    iteracion, fallos_seguidos = 0, 0
+    while time.perf_counter() < fin and fallos_seguidos < MAX_FALLOS_SEGUIDOS:
+        pagina, paso = random.choice(ESCENARIOS[rol])
+        try:
+            paso(at, iteracion)
+            fallos_seguidos = fallos_seguidos + 1 if ejecutar_medido(at, pagina, registro) else 0
+        except (StopIteration, IndexError):
+            # Elemento esperado ausente (p. ej. sin productos): se cuenta como error
+            registro.append((pagina, 0.0, 0, 1))
+            fallos_seguidos += 1
+            at.run()
+        iteracion += 1
+
+# Sesión previa sin medir para cargar módulos, conexión y cachés del proceso
+def calentar(args):
+    registro = []
+    at = iniciar_sesion(args, "admin", registro)
+    for _, paso in ESCENARIOS["admin"]:
+        paso(at, 0)
+        at.run()
+
+def memoria_rss_mb():
+    try:
+        with open("/proc/self/status") as estado:
+            for linea in estado:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def repartir_roles(usuarios, mezcla):
+    roles = []
+    for rol, peso in mezcla.items():
+        roles += [rol] * peso
+    return [roles[i % len(roles)] for i in range(usuarios)]
+
+def percentil(valores, p):
+    if len(valores) < 2:
+        return valores[0] if valores else 0.0
+    return statistics.quantiles(valores, n=100)[p - 1]
+
+def ejecutar_nivel(args, usuarios, mezcla):
+    memoria_inicial = memoria_rss_mb()
+    registro, sesiones = [], []
+    fin = time.perf_counter() + args.duracion
+
+    hilos = [
+        threading.Thread(target=usuario_virtual, args=(args, rol, fin, registro, sesiones))
+        for rol in repartir_roles(usuarios, mezcla)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    memoria_sesion = (memoria_rss_mb() - memoria_inicial) / max(len(sesiones), 1)
+    latencias = [r[1] * 1000 for r in registro if not r[3]]
+    por_pagina = defaultdict(list)
+    for pagina, latencia, consultas, errores in registro:
+        if not errores:
+            por_pagina[pagina].append((latencia * 1000, consultas))
+
+    return {
+        "usuarios": usuarios,
+        "reruns": len(registro),
+        "reruns_s": len(registro) / args.duracion,
+        "p50": percentil(latencias, 50),
+        "p95": percentil(latencias, 95),
+        "p99": percentil(latencias, 99),
+        "consultas": statistics.mean([r[2] for r in registro]) if registro else 0,
+        "errores": sum(1 for r in registro if r[3]),
+        "memoria": memoria_sesion,
+        "por_pagina": por_pagina,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de app_ferreteria.py")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--db", default="ferreteria_carga")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--sembrar", action="store_true", help="Insertar datos sintéticos antes de medir")
+    parser.add_argument("--productos", type=int, default=2000)
+    parser.add_argument("--clientes", type=int, default=5000)
+    parser.add_argument("--ventas", type=int, default=100000)
+    parser.add_argument("--niveles", default="1,2,4,8,16", help="Usuarios concurrentes por nivel")
+    parser.add_argument("--mezcla", default="admin=1,vendedor=3,inventarista=1",
+                        help="Peso de cada rol en la mezcla de usuarios")
+    parser.add_argument("--duracion", type=float, default=30, help="Segundos por nivel")
+    parser.add_argument("--timeout", type=float, default=60, help="Tiempo máximo por rerun")
+    parser.add_argument("--ignorar-version", action="store_true",
+                        help="Ejecutar aunque la versión de Streamlit no esté verificada")
+    args = parser.parse_args()
+
+    if not args.ignorar_version:
+        verificar_version_streamlit()
+
+    if args.sembrar:
+        sembrar(args)
+
+    mezcla = {rol: int(peso) for rol, peso in (p.split("=") for p in args.mezcla.split(","))}
+    instalar_contador_consultas()
+    preparar_sesiones_concurrentes(args)
+    calentar(args)
+
+    print(f"{'Usuarios':>8} {'Reruns':>7} {'Reruns/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'Consultas':>10} {'Errores':>8} {'MB/sesión':>10}")
+    for usuarios in [int(n) for n in args.niveles.split(",")]:
+        r = ejecutar_nivel(args, usuarios, mezcla)
+        print(f"{r['usuarios']:>8} {r['reruns']:>7} {r['reruns_s']:>9.1f} {r['p50']:>8.0f} {r['p95']:>8.0f} "
+              f"{r['p99']:>8.0f} {r['consultas']:>10.1f} {r['errores']:>8} {r['memoria']:>10.1f}")
+        for pagina, datos in sorted(r["por_pagina"].items()):
+            latencias = [d[0] for d in datos]
+            print(f"{'':>8}   {pagina:<18} n={len(datos):<5} p95={percentil(latencias, 95):>6.0f} ms "
+                  f"consultas={statistics.mean(d[1] for d in datos):.1f}")
+
+if __name__ == "__main__":
+    main()